@@ -1,4 +1,4 @@
-import os, re, time, json
+import os, re, time, json, hashlib
 import PIL.Image, PIL.ImageFont, PIL.ImageDraw
 import numpy as np
 
@@ -52,13 +52,29 @@ display_images(training_images, training_labels, training_labels, "Training Data
 display_images(validation_images, validation_labels, validation_labels, "Training Data" )
 validation_images[0].astype('float32').shape
 
+# runs inside the model on every batch, so the dataset stays uint8 and is never copied as float32
 def preprocess_image_input(input_images):
-  input_images = input_images.astype('float32')
+  input_images = tf.cast(input_images, tf.float32)
   output_ims = tf.keras.applications.resnet50.preprocess_input(input_images)
   return output_ims
 
-train_X = preprocess_image_input(training_images)
-valid_X = preprocess_image_input(validation_images)
+
+# stream uint8 batches by index: shuffling the indices keeps the images themselves in one place.
+# `labels` can be a tuple of arrays, e.g. labels and teacher logits.
+def make_dataset(images, labels, batch_size=64, shuffle=False):
+  images = tf.constant(images)
+  labels = tf.nest.map_structure(tf.constant, labels)
+  dataset = tf.data.Dataset.range(len(images))
+  if shuffle:
+    dataset = dataset.shuffle(len(images))
+  dataset = dataset.batch(batch_size)
+  dataset = dataset.map(lambda indices: (tf.gather(images, indices),
+                                         tf.nest.map_structure(lambda t: tf.gather(t, indices), labels)),
+                        num_parallel_calls=tf.data.AUTOTUNE)
+  return dataset.prefetch(tf.data.AUTOTUNE)
+
+train_dataset = make_dataset(training_images, training_labels, shuffle=True)
+valid_dataset = make_dataset(validation_images, validation_labels)
 
 '''
 Feature Extraction is performed by ResNet50 pretrained on imagenet weights. 
@@ -86,9 +102,11 @@ def classifier(inputs):
 '''
 Since input image size is (32 x 32), first upsample the image by factor of (7x7) to transform it to (224 x 224)
 Connect the feature extraction and "classifier" layers to build the model.
+The inputs are uint8, the ResNet preprocessing is the first layer.
 '''
 def final_model(inputs):
-    resize = tf.keras.layers.UpSampling2D(size=(7, 7))(inputs)
+    preprocessed = tf.keras.layers.Lambda(preprocess_image_input, name='preprocess')(inputs)
+    resize = tf.keras.layers.UpSampling2D(size=(7, 7))(preprocessed)
     resnet_feature_extractor = feature_extractor(resize)
     classification_output = classifier(resnet_feature_extractor)
     return classification_output
@@ -100,7 +118,7 @@ Use Stochastic Gradient Descent as the optimizer.
 Use Sparse Categorical CrossEntropy as the loss function.
 '''
 def define_compile_model():
-    inputs = tf.keras.layers.Input(shape=(32, 32, 3))
+    inputs = tf.keras.layers.Input(shape=(32, 32, 3), dtype=tf.uint8)
     classification_output = final_model(inputs)
     model = tf.keras.Model(inputs=inputs, outputs=classification_output)
     model.compile(optimizer='SGD',
@@ -112,14 +130,221 @@ def define_compile_model():
 model = define_compile_model()
 print(model.summary())
 
+
+'''
+Records the training time until the validation accuracy first reaches `target`.
+The clock starts at the first fit, so a run split over several fit calls is timed as a whole.
+'''
+class TimeToAccuracy(tf.keras.callbacks.Callback):
+    def __init__(self, target):
+        super().__init__()
+        self.target = target
+        self.start = None
+        self.seconds = None
+        self.epochs = None
+        self.total_epochs = 0
+
+    def on_train_begin(self, logs=None):
+        if self.start is None:
+            self.start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.total_epochs += 1
+        if self.seconds is None and logs.get('val_accuracy', 0) >= self.target:
+            self.seconds = time.perf_counter() - self.start
+            self.epochs = self.total_epochs
+
+
 EPOCHS = 4
-history = model.fit(train_X, training_labels, epochs=EPOCHS, validation_data = (valid_X, validation_labels), batch_size=64)
+TARGET_ACCURACY = 0.9
+# the trained model is kept on disk and reloaded by later runs (it is also the distillation teacher
+# below, whose cached logits are keyed on these weights); delete the file to train again
+MODEL_WEIGHTS_FILE = './cifar10_resnet50.weights.h5'
+fixed_timer = TimeToAccuracy(TARGET_ACCURACY)
+if os.path.exists(MODEL_WEIGHTS_FILE):
+    model.load_weights(MODEL_WEIGHTS_FILE)
+    history = None
+else:
+    history = model.fit(train_dataset, epochs=EPOCHS, validation_data=valid_dataset, callbacks=[fixed_timer])
+    model.save_weights(MODEL_WEIGHTS_FILE)
 
-loss, accuracy = model.evaluate(valid_X, validation_labels, batch_size=64)
-plot_metrics(history, "loss", "Loss")
-plot_metrics(history, "accuracy", "Accuracy")
+loss, accuracy = model.evaluate(valid_dataset)
+if history is not None:
+    plot_metrics(history, "loss", "Loss")
+    plot_metrics(history, "accuracy", "Accuracy")
 
-probabilities = model.predict(valid_X, batch_size=64)
+probabilities = model.predict(valid_dataset)
 probabilities = np.argmax(probabilities, axis = 1)
 
-display_images(validation_images, probabilities, validation_labels, "Bad predictions indicated in red.")
\ No newline at end of file
+display_images(validation_images, probabilities, validation_labels, "Bad predictions indicated in red.")
+
+
+'''
+Progressive resizing: the early epochs see the images upsampled by a small factor, the UpSampling2D
+factor grows on RESOLUTION_SCHEDULE and the last epochs run at the full 224 x 224. ResNet50 is fully
+convolutional, so one backbone and one classifier head are shared by a model per resolution and the
+weights carry over from one resolution to the next.
+'''
+PROGRESSIVE_RESIZING = False
+# epoch at which each upsampling factor starts: 64 x 64, then 128 x 128, then 224 x 224
+RESOLUTION_SCHEDULE = {0: 2, 2: 4, 3: 7}
+
+
+def define_compile_progressive_models(factors):
+    backbone = tf.keras.applications.resnet.ResNet50(input_shape=(None, None, 3),
+                                                     include_top=False,
+                                                     weights='imagenet')
+    head_inputs = tf.keras.layers.Input(shape=backbone.output_shape[1:])
+    head = tf.keras.Model(inputs=head_inputs, outputs=classifier(head_inputs))
+    # one optimizer for all the models, they train the same variables
+    optimizer = tf.keras.optimizers.SGD()
+
+    models = {}
+    for factor in factors:
+        inputs = tf.keras.layers.Input(shape=(32, 32, 3), dtype=tf.uint8)
+        preprocessed = tf.keras.layers.Lambda(preprocess_image_input, name='preprocess')(inputs)
+        resize = tf.keras.layers.UpSampling2D(size=(factor, factor))(preprocessed)
+        models[factor] = tf.keras.Model(inputs=inputs, outputs=head(backbone(resize)))
+        models[factor].compile(optimizer=optimizer,
+                               loss='sparse_categorical_crossentropy',
+                               metrics=['accuracy'])
+    return models
+
+
+if PROGRESSIVE_RESIZING:
+    progressive_models = define_compile_progressive_models(sorted(set(RESOLUTION_SCHEDULE.values())))
+    progressive_timer = TimeToAccuracy(TARGET_ACCURACY)
+    start_epochs = sorted(RESOLUTION_SCHEDULE)
+    for start_epoch, end_epoch in zip(start_epochs, start_epochs[1:] + [EPOCHS]):
+        factor = RESOLUTION_SCHEDULE[start_epoch]
+        print('Epochs {}-{} at {} x {}'.format(start_epoch + 1, end_epoch, 32 * factor, 32 * factor))
+        progressive_models[factor].fit(train_dataset, initial_epoch=start_epoch, epochs=end_epoch,
+                                       validation_data=valid_dataset, callbacks=[progressive_timer])
+
+    print('Time to {:.0%} validation accuracy'.format(TARGET_ACCURACY))
+    for name, timer in (('fixed 224', fixed_timer), ('progressive', progressive_timer)):
+        if timer.start is None:
+            print('{:<12} not trained in this run, weights loaded from {}'.format(name, MODEL_WEIGHTS_FILE))
+        elif timer.seconds is None:
+            print('{:<12} not reached in {} epochs'.format(name, EPOCHS))
+        else:
+            print('{:<12} {:>8.1f}s {:>3} epochs'.format(name, timer.seconds, timer.epochs))
+
+
+'''
+Distillation: a small CNN at the native 32 x 32 resolution learns from the softened outputs of the
+ResNet50 teacher above, for CPU serving. The teacher runs once over the training set and its logits
+are cached in TEACHER_LOGITS_DIR under a hash of the teacher weights. The teacher is reloaded from
+MODEL_WEIGHTS_FILE on later runs, so they hit the cache; a retrained teacher gets new logits.
+'''
+DISTILL = False
+TEACHER_LOGITS_DIR = './teacher_logits'
+TEMPERATURE = 4.0
+ALPHA = 0.1  # weight of the hard-label loss, the rest goes to matching the teacher
+STUDENT_EPOCHS = 30
+
+
+def define_student():
+    inputs = tf.keras.layers.Input(shape=(32, 32, 3), dtype=tf.uint8)
+    x = tf.keras.layers.Rescaling(1. / 255)(inputs)
+    for filters in (32, 64, 128):
+        x = tf.keras.layers.Conv2D(filters, 3, padding='same', use_bias=False)(x)
+        x = tf.keras.layers.BatchNormalization()(x)
+        x = tf.keras.layers.ReLU()(x)
+        x = tf.keras.layers.Conv2D(filters, 3, padding='same', use_bias=False)(x)
+        x = tf.keras.layers.BatchNormalization()(x)
+        x = tf.keras.layers.ReLU()(x)
+        x = tf.keras.layers.MaxPooling2D()(x)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    logits = tf.keras.layers.Dense(10, name="logits")(x)
+    return tf.keras.Model(inputs=inputs, outputs=logits, name='student')
+
+
+'''
+Trains the student on a mix of the hard labels and the KL divergence to the teacher, both softened
+by the temperature. The T^2 factor keeps the soft-target gradients on the scale of the hard ones.
+'''
+class Distiller(tf.keras.Model):
+    def __init__(self, student, temperature, alpha):
+        super().__init__()
+        self.student = student
+        self.temperature = temperature
+        self.alpha = alpha
+        self.loss_tracker = tf.keras.metrics.Mean(name='loss')
+        self.accuracy = tf.keras.metrics.SparseCategoricalAccuracy(name='accuracy')
+
+    @property
+    def metrics(self):
+        return [self.loss_tracker, self.accuracy]
+
+    def call(self, inputs, training=False):
+        return self.student(inputs, training=training)
+
+    def train_step(self, data):
+        images, (labels, teacher_logits) = data
+        with tf.GradientTape() as tape:
+            student_logits = self.student(images, training=True)
+            hard_loss = tf.keras.losses.sparse_categorical_crossentropy(labels, student_logits, from_logits=True)
+            soft_loss = tf.keras.losses.kl_divergence(tf.nn.softmax(teacher_logits / self.temperature),
+                                                      tf.nn.softmax(student_logits / self.temperature))
+            loss = tf.reduce_mean(self.alpha * hard_loss + (1 - self.alpha) * self.temperature ** 2 * soft_loss)
+        gradients = tape.gradient(loss, self.student.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.student.trainable_variables))
+        self.loss_tracker.update_state(loss)
+        self.accuracy.update_state(labels, student_logits)
+        return {m.name: m.result() for m in self.metrics}
+
+    def test_step(self, data):
+        images, labels = data
+        student_logits = self.student(images, training=False)
+        self.loss_tracker.update_state(
+            tf.keras.losses.sparse_categorical_crossentropy(labels, student_logits, from_logits=True))
+        self.accuracy.update_state(labels, student_logits)
+        return {m.name: m.result() for m in self.metrics}
+
+
+def teacher_logits(teacher, images, labels):
+    weights_hash = hashlib.sha1()
+    for weight in teacher.get_weights():
+        weights_hash.update(weight.tobytes())
+    logits_file = os.path.join(TEACHER_LOGITS_DIR, weights_hash.hexdigest()[:16] + '.npy')
+    if os.path.exists(logits_file):
+        return np.load(logits_file)
+    # the teacher ends in a softmax, its log probabilities are the logits up to a per-image constant
+    probabilities = teacher.predict(make_dataset(images, labels))
+    logits = np.log(np.maximum(probabilities, 1e-7)).astype(np.float32)
+    os.makedirs(TEACHER_LOGITS_DIR, exist_ok=True)
+    np.save(logits_file, logits)
+    return logits
+
+
+def cpu_latency_ms(model, images, repeats=20):
+    with tf.device('/cpu:0'):
+        predict = tf.function(lambda batch: model(batch, training=False))
+        batch = tf.constant(images)
+        predict(batch)  # trace and warm up
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            predict(batch).numpy()
+            times.append(time.perf_counter() - start)
+    return np.median(times) * 1000
+
+
+if DISTILL:
+    train_logits = teacher_logits(model, training_images, training_labels)
+    distill_dataset = make_dataset(training_images, (training_labels, train_logits), shuffle=True)
+
+    student = define_student()
+    distiller = Distiller(student, temperature=TEMPERATURE, alpha=ALPHA)
+    distiller.compile(optimizer=tf.keras.optimizers.Adam())
+    distiller.fit(distill_dataset, epochs=STUDENT_EPOCHS, validation_data=valid_dataset)
+    _, student_accuracy = distiller.evaluate(valid_dataset)
+
+    print('{:<8} {:>10} {:>9} {:>12} {:>12} {:>9}'.format('model', 'params', 'accuracy', 'batch size',
+                                                          'ms/batch', 'ms/image'))
+    for name, serving_model, model_accuracy in (('teacher', model, accuracy), ('student', student, student_accuracy)):
+        for batch_size in (1, 64):
+            latency = cpu_latency_ms(serving_model, validation_images[:batch_size])
+            print('{:<8} {:>10} {:>9.2%} {:>12} {:>12.2f} {:>9.2f}'.format(
+                name, serving_model.count_params(), model_accuracy, batch_size, latency, latency / batch_size))
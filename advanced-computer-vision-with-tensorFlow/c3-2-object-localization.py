@@ -5,6 +5,8 @@ import tensorflow as tf
 from matplotlib import pyplot as plt
 import tensorflow_datasets as tfds
 
+from utility import intersection_over_union
+
 # @title Plot Utilities for Bounding Boxes [RUN ME]
 
 im_width = 75
@@ -428,28 +430,6 @@ print("Validation accuracy: ", classification_accuracy)
 plot_metrics(history, "classification_loss", "Classification Loss")
 plot_metrics(history, "bounding_box_loss", "Bounding Box Loss")
 
-#Intersection over union
-def intersection_over_union(pred_box, true_box):
-    xmin_pred, ymin_pred, xmax_pred, ymax_pred = np.split(pred_box, 4, axis=1)
-    xmin_true, ymin_true, xmax_true, ymax_true = np.split(true_box, 4, axis=1)
-
-    smoothing_factor = 1e-10
-
-    xmin_overlap = np.maximum(xmin_pred, xmin_true)
-    xmax_overlap = np.minimum(xmax_pred, xmax_true)
-    ymin_overlap = np.maximum(ymin_pred, ymin_true)
-    ymax_overlap = np.minimum(ymax_pred, ymax_true)
-
-    pred_box_area = (xmax_pred - xmin_pred) * (ymax_pred - ymin_pred)
-    true_box_area = (xmax_true - xmin_true) * (ymax_true - ymin_true)
-
-    overlap_area = np.maximum((xmax_overlap - xmin_overlap), 0) * np.maximum((ymax_overlap - ymin_overlap), 0)
-    union_area = (pred_box_area + true_box_area) - overlap_area
-
-    iou = (overlap_area + smoothing_factor) / (union_area + smoothing_factor)
-
-    return iou
-
 # recognize validation digits
 predictions = model.predict(validation_digits, batch_size=64)
 predicted_labels = np.argmax(predictions[0], axis=1)
@@ -0,0 +1,88 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from utility import intersection_over_union, iou_matrix, iou_matrix_tiled, ragged_iou_matrices, \
+    tf_ragged_iou_matrices
+
+# Throughput of all-pairs IoU between the predictions and the ground truths of every image, as
+# needed for matching, NMS and mAP: looping intersection_over_union of c3-2 image by image against
+# the vectorized NumPy and TF versions in utility.py. Also checks the tiled version for a large N.
+
+NUM_IMAGES = 2000
+MEAN_PREDICTIONS = 100
+MAX_GROUND_TRUTHS = 20
+LARGE_N = 200000
+REPEATS = 3
+
+rng = np.random.default_rng(0)
+
+
+def random_boxes(count):
+    corners = rng.random((count, 2, 2)).astype(np.float32)
+    return np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+
+
+pred_row_lengths = rng.poisson(MEAN_PREDICTIONS, NUM_IMAGES)
+true_row_lengths = rng.integers(1, MAX_GROUND_TRUTHS + 1, NUM_IMAGES)
+pred_boxes = random_boxes(pred_row_lengths.sum())
+true_boxes = random_boxes(true_row_lengths.sum())
+num_pairs = int((pred_row_lengths * true_row_lengths).sum())
+
+
+def looped():
+    # the aligned function, fed every (prediction, ground truth) pair of one image at a time
+    matrices = []
+    pred_starts = np.cumsum(pred_row_lengths) - pred_row_lengths
+    true_starts = np.cumsum(true_row_lengths) - true_row_lengths
+    for pred_start, n, true_start, m in zip(pred_starts, pred_row_lengths, true_starts, true_row_lengths):
+        pred = pred_boxes[pred_start:pred_start + n]
+        true = true_boxes[true_start:true_start + m]
+        iou = intersection_over_union(np.repeat(pred, m, axis=0), np.tile(true, (n, 1)))
+        matrices.append(iou.reshape(n, m))
+    return matrices
+
+
+ragged_pred_boxes = tf.RaggedTensor.from_row_lengths(pred_boxes, pred_row_lengths)
+ragged_true_boxes = tf.RaggedTensor.from_row_lengths(true_boxes, true_row_lengths)
+tf_ragged = tf.function(tf_ragged_iou_matrices)
+
+
+def best_seconds(function):
+    function()  # warm up, and trace the tf.function
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# all three have to agree before their speed means anything
+reference = looped()
+values, row_splits = ragged_iou_matrices(pred_boxes, pred_row_lengths, true_boxes, true_row_lengths)
+assert np.allclose(np.concatenate([matrix.ravel() for matrix in reference]), values)
+assert np.allclose(tf_ragged(ragged_pred_boxes, ragged_true_boxes).flat_values.numpy(), values)
+
+print('{} images, {} prediction/ground truth pairs'.format(NUM_IMAGES, num_pairs))
+baseline = None
+for name, function in (
+        ('looped intersection_over_union', looped),
+        ('ragged_iou_matrices (NumPy)', lambda: ragged_iou_matrices(pred_boxes, pred_row_lengths,
+                                                                    true_boxes, true_row_lengths)),
+        ('tf_ragged_iou_matrices (TF)', lambda: tf_ragged(ragged_pred_boxes, ragged_true_boxes).flat_values.numpy()),
+):
+    seconds = best_seconds(function)
+    baseline = baseline or seconds
+    print('{:<32} {:>14.0f} pairs/sec {:>8.1f}x'.format(name, num_pairs / seconds, baseline / seconds))
+
+# one image with a very large number of candidate boxes
+large_pred = random_boxes(LARGE_N)
+large_true = random_boxes(MAX_GROUND_TRUTHS)
+assert np.allclose(iou_matrix_tiled(large_pred, large_true), iou_matrix(large_pred, large_true))
+for name, function in (('iou_matrix', lambda: iou_matrix(large_pred, large_true)),
+                       ('iou_matrix_tiled', lambda: iou_matrix_tiled(large_pred, large_true))):
+    seconds = best_seconds(function)
+    print('{:<32} {:>14.0f} pairs/sec ({} x {})'.format(name, LARGE_N * MAX_GROUND_TRUTHS / seconds,
+                                                        LARGE_N, MAX_GROUND_TRUTHS))
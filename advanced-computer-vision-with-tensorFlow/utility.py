@@ -0,0 +1,117 @@
+import numpy as np
+import tensorflow as tf
+
+# Boxes are (xmin, ymin, xmax, ymax) on the last axis, as in c3-2-object-localization.py
+SMOOTHING_FACTOR = 1e-10
+
+
+# Intersection over union of aligned boxes, pred_box[i] against true_box[i]
+def intersection_over_union(pred_box, true_box):
+    xmin_pred, ymin_pred, xmax_pred, ymax_pred = np.split(pred_box, 4, axis=1)
+    xmin_true, ymin_true, xmax_true, ymax_true = np.split(true_box, 4, axis=1)
+
+    smoothing_factor = SMOOTHING_FACTOR
+
+    xmin_overlap = np.maximum(xmin_pred, xmin_true)
+    xmax_overlap = np.minimum(xmax_pred, xmax_true)
+    ymin_overlap = np.maximum(ymin_pred, ymin_true)
+    ymax_overlap = np.minimum(ymax_pred, ymax_true)
+
+    pred_box_area = (xmax_pred - xmin_pred) * (ymax_pred - ymin_pred)
+    true_box_area = (xmax_true - xmin_true) * (ymax_true - ymin_true)
+
+    overlap_area = np.maximum((xmax_overlap - xmin_overlap), 0) * np.maximum((ymax_overlap - ymin_overlap), 0)
+    union_area = (pred_box_area + true_box_area) - overlap_area
+
+    iou = (overlap_area + smoothing_factor) / (union_area + smoothing_factor)
+
+    return iou
+
+
+# Same formula on boxes of any broadcastable shape (..., 4), with NumPy or TF ops
+def _broadcast_iou(boxes_a, boxes_b, maximum, minimum):
+    xmin_overlap = maximum(boxes_a[..., 0], boxes_b[..., 0])
+    ymin_overlap = maximum(boxes_a[..., 1], boxes_b[..., 1])
+    xmax_overlap = minimum(boxes_a[..., 2], boxes_b[..., 2])
+    ymax_overlap = minimum(boxes_a[..., 3], boxes_b[..., 3])
+
+    area_a = (boxes_a[..., 2] - boxes_a[..., 0]) * (boxes_a[..., 3] - boxes_a[..., 1])
+    area_b = (boxes_b[..., 2] - boxes_b[..., 0]) * (boxes_b[..., 3] - boxes_b[..., 1])
+
+    overlap_area = maximum(xmax_overlap - xmin_overlap, 0) * maximum(ymax_overlap - ymin_overlap, 0)
+    union_area = area_a + area_b - overlap_area
+    return (overlap_area + SMOOTHING_FACTOR) / (union_area + SMOOTHING_FACTOR)
+
+
+def iou_matrix(boxes_a, boxes_b):
+    # all-pairs IoU: (..., N, 4) against (..., M, 4) gives (..., N, M); leading axes broadcast, so a
+    # padded batch of images works as well as a single image
+    boxes_a = np.asarray(boxes_a)
+    boxes_b = np.asarray(boxes_b)
+    return _broadcast_iou(boxes_a[..., :, None, :], boxes_b[..., None, :, :], np.maximum, np.minimum)
+
+
+def iou_matrix_tiled(boxes_a, boxes_b, tile_size=4096):
+    # iou_matrix of (N, 4) against (M, 4) for a very large N: works through `tile_size` rows at a time,
+    # so the temporaries stay at tile_size x M instead of N x M each
+    boxes_a = np.asarray(boxes_a)
+    boxes_b = np.asarray(boxes_b)
+    result = np.empty((len(boxes_a), len(boxes_b)), dtype=np.result_type(boxes_a, boxes_b, np.float32))
+    for start in range(0, len(boxes_a), tile_size):
+        result[start:start + tile_size] = iou_matrix(boxes_a[start:start + tile_size], boxes_b)
+    return result
+
+
+def _ragged_pair_indices(pred_row_lengths, true_row_lengths, xp):
+    # indices into the flat prediction and ground truth boxes of every (prediction, ground truth) pair
+    # of the same image, ordered by image, then prediction, then ground truth
+    pairs_per_image = pred_row_lengths * true_row_lengths
+    num_images = xp['size'](pred_row_lengths)
+    image = xp['repeat'](xp['range'](num_images), pairs_per_image)
+    pair_in_image = xp['range'](xp['sum'](pairs_per_image)) - xp['repeat'](
+        xp['cumsum'](pairs_per_image) - pairs_per_image, pairs_per_image)
+    columns = xp['gather'](true_row_lengths, image)
+    pred_index = xp['gather'](xp['cumsum'](pred_row_lengths) - pred_row_lengths, image) + pair_in_image // columns
+    true_index = xp['gather'](xp['cumsum'](true_row_lengths) - true_row_lengths, image) + pair_in_image % columns
+    return pred_index, true_index
+
+
+_NUMPY_OPS = {'size': np.size, 'repeat': np.repeat, 'range': np.arange, 'sum': np.sum, 'cumsum': np.cumsum,
+              'gather': lambda params, indices: params[indices]}
+_TF_OPS = {'size': tf.size, 'repeat': tf.repeat, 'range': tf.range, 'sum': tf.reduce_sum, 'cumsum': tf.cumsum,
+           'gather': tf.gather}
+
+
+def ragged_iou_matrices(pred_boxes, pred_row_lengths, true_boxes, true_row_lengths):
+    # Per-image N_i x M_i IoU matrices for a whole evaluation set in one vectorized pass. The boxes of
+    # all images are concatenated, (sum N_i, 4) and (sum M_i, 4), with the number of boxes per image
+    # in the row lengths. Returns (values, row_splits): image i's matrix is
+    # values[row_splits[i]:row_splits[i + 1]].reshape(N_i, M_i).
+    pred_row_lengths = np.asarray(pred_row_lengths, dtype=np.int64)
+    true_row_lengths = np.asarray(true_row_lengths, dtype=np.int64)
+    pred_index, true_index = _ragged_pair_indices(pred_row_lengths, true_row_lengths, _NUMPY_OPS)
+    values = _broadcast_iou(np.asarray(pred_boxes)[pred_index], np.asarray(true_boxes)[true_index],
+                            np.maximum, np.minimum)
+    row_splits = np.concatenate([[0], np.cumsum(pred_row_lengths * true_row_lengths)])
+    return values, row_splits
+
+
+def tf_iou_matrix(boxes_a, boxes_b):
+    # TF version of iou_matrix, usable inside a tf.function or a tf.data map
+    boxes_a = tf.convert_to_tensor(boxes_a)
+    boxes_b = tf.convert_to_tensor(boxes_b, dtype=boxes_a.dtype)
+    return _broadcast_iou(boxes_a[..., :, None, :], boxes_b[..., None, :, :], tf.maximum, tf.minimum)
+
+
+def tf_ragged_iou_matrices(pred_boxes, true_boxes):
+    # pred_boxes [images, (N), 4] and true_boxes [images, (M), 4] as RaggedTensors give the IoU
+    # matrices as a RaggedTensor [images, (N), (M)]
+    pred_row_lengths = pred_boxes.row_lengths()
+    true_row_lengths = true_boxes.row_lengths()
+    pred_index, true_index = _ragged_pair_indices(pred_row_lengths, true_row_lengths, _TF_OPS)
+    values = _broadcast_iou(tf.gather(pred_boxes.flat_values, pred_index),
+                            tf.gather(true_boxes.flat_values, true_index),
+                            tf.maximum, tf.minimum)
+    # every prediction row of image i holds M_i values
+    return tf.RaggedTensor.from_nested_row_lengths(
+        values, [pred_row_lengths, tf.repeat(true_row_lengths, pred_row_lengths)])
@@ -0,0 +1,156 @@
+import multiprocessing
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from utility import free_ports
+
+# Asynchronous training of the c2-6 model with ParameterServerStrategy and a ClusterCoordinator.
+# The cluster (NUM_WORKERS workers and NUM_PS parameter servers) runs as in-process servers, so the
+# whole thing works on one machine. Variables are sharded across the parameter servers, and at the
+# end the throughput is compared against the synchronous MirroredStrategy loop of c2-6.
+
+NUM_WORKERS = 3
+NUM_PS = 2
+EPOCHS = 5
+BATCH_SIZE_PER_WORKER = 64
+# shard any variable bigger than this across the parameter servers
+MIN_SHARD_BYTES = 256 << 10
+
+
+def create_in_process_cluster(num_workers, num_ps):
+    ports = free_ports(num_workers + num_ps)
+    cluster_dict = {
+        'worker': ['localhost:{}'.format(port) for port in ports[:num_workers]],
+        'ps': ['localhost:{}'.format(port) for port in ports[num_workers:]],
+    }
+    cluster_spec = tf.train.ClusterSpec(cluster_dict)
+
+    # workers need enough inter-op threads to run the scheduled functions concurrently
+    worker_config = tf.compat.v1.ConfigProto()
+    if multiprocessing.cpu_count() < num_workers + 1:
+        worker_config.inter_op_parallelism_threads = num_workers + 1
+
+    for index in range(num_workers):
+        tf.distribute.Server(cluster_spec, job_name='worker', task_index=index,
+                             config=worker_config, protocol='grpc')
+    for index in range(num_ps):
+        tf.distribute.Server(cluster_spec, job_name='ps', task_index=index, protocol='grpc')
+
+    return tf.distribute.cluster_resolver.SimpleClusterResolver(cluster_spec, rpc_layer='grpc')
+
+
+# Get the data
+fashion_mnist = tf.keras.datasets.fashion_mnist
+(train_images, train_labels), _ = fashion_mnist.load_data()
+train_images = train_images[..., None] / np.float32(255)
+# every scheduled step is one batch of BATCH_SIZE_PER_WORKER on whichever worker picks it up
+steps_per_epoch = len(train_images) // BATCH_SIZE_PER_WORKER
+
+
+def dataset_fn(input_context):
+    dataset = tf.data.Dataset.from_tensor_slices((train_images, train_labels))
+    dataset = dataset.shard(input_context.num_input_pipelines, input_context.input_pipeline_id)
+    return dataset.shuffle(len(train_images)).batch(BATCH_SIZE_PER_WORKER).repeat().prefetch(2)
+
+
+# Create the model architecture
+def create_model():
+    model = tf.keras.Sequential([
+        tf.keras.layers.Conv2D(32, 3, activation='relu'),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Conv2D(64, 3, activation='relu'),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(64, activation='relu'),
+        tf.keras.layers.Dense(10)
+    ])
+    # create the variables now, inside the strategy scope, so they are placed on the parameter servers
+    model.build((None, 28, 28, 1))
+    return model
+
+
+def build_training(strategy):
+    with strategy.scope():
+        model = create_model()
+        optimizer = tf.keras.optimizers.Adam()
+        train_accuracy = tf.keras.metrics.SparseCategoricalAccuracy(name='train_accuracy')
+        loss_object = tf.keras.losses.SparseCategoricalCrossentropy(
+            from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+
+    def train_step(images, labels):
+        with tf.GradientTape() as tape:
+            predictions = model(images, training=True)
+            # the average is over this worker's batch, each worker applies its own update
+            loss = tf.nn.compute_average_loss(loss_object(labels, predictions))
+        gradients = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        train_accuracy.update_state(labels, predictions)
+        return loss
+
+    @tf.function
+    def distributed_train_step(iterator):
+        images, labels = next(iterator)
+        per_replica_losses = strategy.run(train_step, args=(images, labels))
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_losses, axis=None)
+
+    return model, train_accuracy, distributed_train_step
+
+
+cluster_resolver = create_in_process_cluster(NUM_WORKERS, NUM_PS)
+variable_partitioner = tf.distribute.experimental.partitioners.MinSizePartitioner(
+    min_shard_bytes=MIN_SHARD_BYTES, max_shards=NUM_PS)
+strategy = tf.distribute.ParameterServerStrategy(cluster_resolver, variable_partitioner=variable_partitioner)
+coordinator = tf.distribute.coordinator.ClusterCoordinator(strategy)
+
+model, train_accuracy, distributed_train_step = build_training(strategy)
+for variable in model.trainable_variables:
+    # sharded variables list one shard per parameter server
+    shards = getattr(variable, 'variables', [variable])
+    print('{}: {} on {}'.format(variable.name, variable.shape, [shard.device for shard in shards]))
+
+
+@tf.function
+def per_worker_dataset_fn():
+    return strategy.distribute_datasets_from_function(dataset_fn)
+
+
+per_worker_iterator = iter(coordinator.create_per_worker_dataset(per_worker_dataset_fn))
+
+# trace and ship the function to the workers before timing, as the mirrored side does below
+coordinator.schedule(distributed_train_step, args=(per_worker_iterator,))
+coordinator.join()
+train_accuracy.reset_states()
+
+start = time.perf_counter()
+for epoch in range(EPOCHS):
+    train_accuracy.reset_states()
+    # schedule is asynchronous: it returns right away and the coordinator dispatches to idle workers
+    losses = [coordinator.schedule(distributed_train_step, args=(per_worker_iterator,))
+              for _ in range(steps_per_epoch)]
+    coordinator.join()
+    train_loss = np.mean([loss.fetch() for loss in losses])
+    print('Epoch {}, Loss: {}, Accuracy: {}'.format(epoch + 1, train_loss, train_accuracy.result() * 100))
+ps_examples_per_sec = EPOCHS * steps_per_epoch * BATCH_SIZE_PER_WORKER / (time.perf_counter() - start)
+
+# Same model, same number of examples with the synchronous MirroredStrategy of c2-6
+mirrored_strategy = tf.distribute.MirroredStrategy()
+global_batch_size = BATCH_SIZE_PER_WORKER * mirrored_strategy.num_replicas_in_sync
+mirrored_dataset = tf.data.Dataset.from_tensor_slices((train_images, train_labels)).shuffle(
+    len(train_images)).batch(global_batch_size).repeat()
+mirrored_iterator = iter(mirrored_strategy.experimental_distribute_dataset(mirrored_dataset))
+_, _, mirrored_train_step = build_training(mirrored_strategy)
+mirrored_steps = EPOCHS * steps_per_epoch * BATCH_SIZE_PER_WORKER // global_batch_size
+
+mirrored_train_step(mirrored_iterator)  # trace before timing
+start = time.perf_counter()
+for _ in range(mirrored_steps):
+    loss = mirrored_train_step(mirrored_iterator)
+loss.numpy()
+mirrored_examples_per_sec = mirrored_steps * global_batch_size / (time.perf_counter() - start)
+
+print('ParameterServerStrategy ({} workers, {} ps): {:.1f} examples/sec'.format(NUM_WORKERS, NUM_PS,
+                                                                               ps_examples_per_sec))
+print('MirroredStrategy ({} replicas): {:.1f} examples/sec'.format(mirrored_strategy.num_replicas_in_sync,
+                                                                  mirrored_examples_per_sec))
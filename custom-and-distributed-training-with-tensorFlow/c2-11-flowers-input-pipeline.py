@@ -0,0 +1,34 @@
+import os
+
+import tensorflow as tf
+
+from utility import convert_to_uint8_tfrecords, get_batched_dataset, get_batched_uint8_dataset, \
+    measure_images_per_second, write_flowers_tfrecords
+
+# Offline benchmark of the flowers input pipeline of c2-6-tpu-strategy.py, no GCS or TPU needed.
+# Local TFRecord shards with the same schema are written once, then every pipeline mode is timed in images/sec.
+
+LOCAL_PATTERN = os.path.join('./dataset', 'flowers-synthetic', '*.tfrec')
+UINT8_CACHE_DIR = os.path.join('./dataset', 'flowers-synthetic-uint8')
+BATCH_SIZE = 128
+NUM_BATCHES = 50
+
+filenames = tf.io.gfile.glob(LOCAL_PATTERN)
+if not filenames:
+    filenames = write_flowers_tfrecords(os.path.dirname(LOCAL_PATTERN))
+print('Benchmarking on {} local files'.format(len(filenames)))
+
+# decode and resize once into the uint8 record format, a complete cache is reused
+uint8_filenames = convert_to_uint8_tfrecords(filenames, UINT8_CACHE_DIR)
+
+modes = {
+    'per-element parse': lambda: get_batched_dataset(filenames, BATCH_SIZE),
+    'batched parse': lambda: get_batched_dataset(filenames, BATCH_SIZE, batch_parse=True),
+    'uint8 cache': lambda: get_batched_uint8_dataset(uint8_filenames, BATCH_SIZE),
+}
+baseline = None
+for name, make_dataset in modes.items():
+    images_per_sec, cpu_seconds_per_batch = measure_images_per_second(make_dataset().repeat(), NUM_BATCHES)
+    baseline = baseline or images_per_sec
+    print('{:<20} {:>10.1f} images/sec ({:.2f}x), host CPU {:.1f} ms/batch'.format(
+        name, images_per_sec, images_per_sec / baseline, cpu_seconds_per_batch * 1000))
@@ -0,0 +1,135 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from utility import LAMB, LARS, WarmupLinearScaling
+
+# Time-to-accuracy of the c2-6 model on Fashion-MNIST for global batch sizes from 128 up to 8k, on
+# logical CPU devices. Plain Adam at its default learning rate is the baseline; LAMB and LARS get the
+# learning rate scaled linearly with the global batch and a linear warmup, which is what the
+# LARGE_BATCH mode of c2-6-tpu-strategy.py uses.
+
+NUM_VIRTUAL_CPUS = 8
+GLOBAL_BATCH_SIZES = [128, 512, 2048, 8192]
+BASE_BATCH_SIZE = 128
+TARGET_ACCURACY = 0.88
+MAX_EPOCHS = 15
+WARMUP_EPOCHS = 2
+
+# logical devices have to be configured before the runtime is initialized
+cpu = tf.config.list_physical_devices('CPU')[0]
+tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * NUM_VIRTUAL_CPUS)
+strategy = tf.distribute.MirroredStrategy(devices=['/cpu:{}'.format(i) for i in range(NUM_VIRTUAL_CPUS)],
+                                          cross_device_ops=tf.distribute.ReductionToOneDevice())
+
+# Get the data
+fashion_mnist = tf.keras.datasets.fashion_mnist
+(train_images, train_labels), (test_images, test_labels) = fashion_mnist.load_data()
+train_images = train_images[..., None] / np.float32(255)
+test_images = test_images[..., None] / np.float32(255)
+
+
+def adam(global_batch_size, steps_per_epoch):
+    return tf.keras.optimizers.Adam()
+
+
+def lamb(global_batch_size, steps_per_epoch):
+    return LAMB(learning_rate=WarmupLinearScaling(0.001, BASE_BATCH_SIZE, global_batch_size,
+                                                  warmup_steps=WARMUP_EPOCHS * steps_per_epoch,
+                                                  total_steps=MAX_EPOCHS * steps_per_epoch))
+
+
+def lars(global_batch_size, steps_per_epoch):
+    return LARS(learning_rate=WarmupLinearScaling(0.1, BASE_BATCH_SIZE, global_batch_size,
+                                                  warmup_steps=WARMUP_EPOCHS * steps_per_epoch,
+                                                  total_steps=MAX_EPOCHS * steps_per_epoch))
+
+
+optimizers = {'Adam': adam, 'LAMB': lamb, 'LARS': lars}
+
+
+# Create the model architecture of c2-6
+def create_model():
+    model = tf.keras.Sequential([
+        tf.keras.layers.Conv2D(32, 3, activation='relu'),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Conv2D(64, 3, activation='relu'),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(64, activation='relu'),
+        tf.keras.layers.Dense(10)
+    ])
+    model.build((None, 28, 28, 1))
+    return model
+
+
+def time_to_accuracy(make_optimizer, global_batch_size):
+    # drop the remainder, every step sees exactly global_batch_size examples split evenly over the replicas
+    steps_per_epoch = len(train_images) // global_batch_size
+    train_dataset = tf.data.Dataset.from_tensor_slices((train_images, train_labels)).shuffle(
+        len(train_images)).batch(global_batch_size, drop_remainder=True).prefetch(2)
+    test_dataset = tf.data.Dataset.from_tensor_slices((test_images, test_labels)).batch(1024)
+    train_dist_dataset = strategy.experimental_distribute_dataset(train_dataset)
+    test_dist_dataset = strategy.experimental_distribute_dataset(test_dataset)
+
+    with strategy.scope():
+        model = create_model()
+        optimizer = make_optimizer(global_batch_size, steps_per_epoch)
+        loss_object = tf.keras.losses.SparseCategoricalCrossentropy(
+            from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+        test_accuracy = tf.keras.metrics.SparseCategoricalAccuracy(name='test_accuracy')
+
+    def train_step(inputs):
+        images, labels = inputs
+        with tf.GradientTape() as tape:
+            predictions = model(images, training=True)
+            # divide by the global batch, the all-reduce in apply_gradients sums the replica gradients
+            loss = tf.nn.compute_average_loss(loss_object(labels, predictions), global_batch_size=global_batch_size)
+        gradients = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        return loss
+
+    def test_step(inputs):
+        images, labels = inputs
+        test_accuracy.update_state(labels, model(images, training=False))
+
+    @tf.function
+    def distributed_train_epoch(dataset):
+        total_loss = tf.constant(0.0)
+        for batch in dataset:
+            total_loss += strategy.reduce(tf.distribute.ReduceOp.SUM,
+                                          strategy.run(train_step, args=(batch,)), axis=None)
+        return total_loss / steps_per_epoch
+
+    @tf.function
+    def distributed_test(dataset):
+        for batch in dataset:
+            strategy.run(test_step, args=(batch,))
+
+    training_time = 0.0
+    for epoch in range(MAX_EPOCHS):
+        start = time.perf_counter()
+        train_loss = distributed_train_epoch(train_dist_dataset)
+        train_loss.numpy()
+        # the first epoch includes tracing, which is the same for every batch size
+        training_time += time.perf_counter() - start
+
+        test_accuracy.reset_states()
+        distributed_test(test_dist_dataset)
+        accuracy = float(test_accuracy.result())
+        if not np.isfinite(train_loss.numpy()):
+            break
+        if accuracy >= TARGET_ACCURACY:
+            return epoch + 1, training_time, accuracy
+    return None, training_time, accuracy
+
+
+print('Time to {:.0%} test accuracy on {} replicas, at most {} epochs'.format(
+    TARGET_ACCURACY, strategy.num_replicas_in_sync, MAX_EPOCHS))
+print('{:>12} {:>10} {:>8} {:>10} {:>10}'.format('global batch', 'optimizer', 'epochs', 'seconds', 'accuracy'))
+for global_batch_size in GLOBAL_BATCH_SIZES:
+    for name, make_optimizer in optimizers.items():
+        epochs, seconds, accuracy = time_to_accuracy(make_optimizer, global_batch_size)
+        print('{:>12} {:>10} {:>8} {:>10.1f} {:>10.2%}'.format(
+            global_batch_size, name, epochs or 'not met', seconds, accuracy))
@@ -87,3 +87,122 @@ weights_list = [{'name': "w",
                     'values': list_b
                 }]
 plot_loss_for_weights(weights_list, losses)
+
+
+# Closed-form solver: instead of running gradient descent for a fixed number of epochs,
+# stream the data once in chunks and accumulate the sufficient statistics X^T X and X^T y.
+# Memory is O(d^2) no matter how many rows go through, and new chunks can be folded in at any time.
+class LeastSquaresSolver():
+    def __init__(self, num_features=1, l2=0.0):
+        # one extra column of ones for the bias
+        dim = num_features + 1
+        self.l2 = l2
+        # accumulate in float64, summing hundreds of millions of rows in float32 loses precision
+        self.xtx = tf.Variable(tf.zeros([dim, dim], dtype=tf.float64), trainable=False)
+        self.xty = tf.Variable(tf.zeros([dim], dtype=tf.float64), trainable=False)
+        self.count = tf.Variable(0, dtype=tf.int64, trainable=False)
+
+    @tf.function
+    def update(self, inputs, outputs):
+        x = tf.cast(inputs, tf.float64)
+        x = tf.reshape(x, [tf.shape(x)[0], -1])
+        x = tf.concat([x, tf.ones_like(x[:, :1])], axis=1)
+        y = tf.reshape(tf.cast(outputs, tf.float64), [-1])
+        self.xtx.assign_add(tf.matmul(x, x, transpose_a=True))
+        self.xty.assign_add(tf.linalg.matvec(x, y, transpose_a=True))
+        self.count.assign_add(tf.shape(x, out_type=tf.int64)[0])
+
+    def update_from_dataset(self, dataset):
+        for inputs, outputs in dataset:
+            self.update(inputs, outputs)
+
+    def solve(self):
+        dim = self.xtx.shape[0]
+        # ridge penalty on the weights only, the bias is not regularized
+        penalty = tf.concat([tf.fill([dim - 1], tf.cast(self.l2, tf.float64)),
+                             tf.zeros([1], dtype=tf.float64)], axis=0)
+        theta = tf.linalg.solve(self.xtx + tf.linalg.diag(penalty), self.xty[:, None])[:, 0]
+        return theta[:-1], theta[-1]
+
+    def fit(self, model):
+        w, b = self.solve()
+        model.w.assign(tf.reshape(tf.cast(w, model.w.dtype), model.w.shape))
+        model.b.assign(tf.cast(b, model.b.dtype))
+        return model
+
+
+CHUNK_SIZE = 256
+solver = LeastSquaresSolver()
+solver.update_from_dataset(tf.data.Dataset.from_tensor_slices((xs, ys)).batch(CHUNK_SIZE))
+model = solver.fit(Model())
+print('Closed form after %d rows: w=%1.4f b=%1.4f, loss=%2.6f' %
+      (solver.count.numpy(), model.w.numpy(), model.b.numpy(), loss(model(xs), ys).numpy()))
+
+# incremental update: fold in new data as it arrives and solve again, no pass over the old rows
+solver.update_from_dataset(tf.data.Dataset.from_tensor_slices((test_inputs, test_outputs)).batch(CHUNK_SIZE))
+model = solver.fit(model)
+print('Closed form after %d rows: w=%1.4f b=%1.4f, loss=%2.6f' %
+      (solver.count.numpy(), model.w.numpy(), model.b.numpy(), loss(model(test_inputs), test_outputs).numpy()))
+
+# ridge baseline
+ridge_solver = LeastSquaresSolver(l2=10.0)
+ridge_solver.update_from_dataset(tf.data.Dataset.from_tensor_slices((xs, ys)).batch(CHUNK_SIZE))
+ridge_model = ridge_solver.fit(Model())
+print('Ridge (l2=%.1f): w=%1.4f b=%1.4f' % (ridge_solver.l2, ridge_model.w.numpy(), ridge_model.b.numpy()))
+
+
+# Ensemble mode: K independent models stacked along a leading axis and trained in one batched step.
+# Every member gets its own learning rate and its own seed for the initial weights.
+class EnsembleModel():
+    def __init__(self, seeds):
+        self.w = tf.Variable(tf.stack([tf.random.stateless_normal([], seed=[seed, 0]) for seed in seeds]))
+        self.b = tf.Variable(tf.stack([tf.random.stateless_normal([], seed=[seed, 1]) for seed in seeds]))
+
+    def __call__(self, x):
+        # [K, 1] * [1, N] -> [K, N], one row of predictions per member
+        return self.w[:, None] * x[None, :] + self.b[:, None]
+
+
+def ensemble_loss(predict_y, target_y):
+    # per-member mean squared error, shape [K]
+    return tf.reduce_mean(tf.square(predict_y - target_y[None, :]), axis=1)
+
+
+@tf.function
+def train_ensemble(model, inputs, outputs, learning_rates):
+    with tf.GradientTape() as t:
+        current_losses = ensemble_loss(model(inputs), outputs)
+        # the members don't share parameters, so the gradient of the sum is each member's own gradient
+        total_loss = tf.reduce_sum(current_losses)
+    dw, db = t.gradient(total_loss, [model.w, model.b])
+    model.w.assign_sub(learning_rates * dw)
+    model.b.assign_sub(learning_rates * db)
+    return current_losses
+
+
+NUM_MEMBERS = 8
+ensemble_learning_rates = tf.constant(np.linspace(0.01, 0.4, NUM_MEMBERS), dtype=tf.float32)
+ensemble = EnsembleModel(seeds=range(NUM_MEMBERS))
+ensemble_list_w, ensemble_list_b, ensemble_losses = [], [], []
+for epoch in epochs:
+    ensemble_list_w.append(ensemble.w.numpy())
+    ensemble_list_b.append(ensemble.b.numpy())
+    ensemble_losses.append(train_ensemble(ensemble, xs, ys, ensemble_learning_rates).numpy())
+
+# shape [epochs, K], column k is the trace of member k
+ensemble_list_w = np.stack(ensemble_list_w)
+ensemble_list_b = np.stack(ensemble_list_b)
+ensemble_losses = np.stack(ensemble_losses)
+final_losses = ensemble_loss(ensemble(xs), ys).numpy()
+best = int(np.argmin(final_losses))
+for k in range(NUM_MEMBERS):
+    print('Member %d: lr=%1.3f w=%1.2f b=%1.2f, loss=%2.5f' %
+          (k, ensemble_learning_rates[k], ensemble.w[k], ensemble.b[k], final_losses[k]))
+print('Best member: %d (lr=%1.3f)' % (best, ensemble_learning_rates[best]))
+
+plt.plot(epochs, ensemble_list_w[:, best], 'r',
+         epochs, ensemble_list_b[:, best], 'b')
+plt.plot([TRUE_w] * len(epochs), 'r--',
+         [TRUE_b] * len(epochs), 'b--')
+plt.legend(['w', 'b', 'True w', 'True b'])
+plt.show()
@@ -5,6 +5,8 @@ import tensorflow as tf
 import tensorflow_datasets as tfds
 from tqdm import tqdm
 
+from utility import BackgroundValidator, TrainLoop, measure_steps_per_second, predict_streaming, steps_per_epoch
+
 train_data, info = tfds.load("fashion_mnist", split="train", with_info=True, data_dir='./dataset/')
 test_data = tfds.load("fashion_mnist", split="test", data_dir='./dataset/')
 
@@ -53,7 +55,7 @@ def apply_gradient(optimizer, model, x, y):
     return logits, loss_value
 
 
-def train_data_for_one_epoch(model):
+def train_data_for_one_epoch(model, optimizer=optimizer):
     losses = []
     pbar = tqdm(total=len(list(enumerate(train))), position=0, leave=True,
                 bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} ')
@@ -80,31 +82,78 @@ def perform_validation(model):
 
 model = base_model()
 
+# run the training steps through the compiled loop engine instead of the eager loop above
+use_compiled_loop = True
+benchmark_loops = False
+
+if benchmark_loops:
+    num_train_steps = steps_per_epoch(train)
+    eager_model = base_model()
+    eager_steps_per_sec = measure_steps_per_second(lambda: train_data_for_one_epoch(eager_model, tf.keras.optimizers.Adam()), num_train_steps)
+    compiled_loop = TrainLoop(base_model(), tf.keras.optimizers.Adam(), loss_object, train_acc_metric,
+                              train.element_spec)
+    compiled_steps_per_sec = measure_steps_per_second(lambda: compiled_loop.train_epoch(train), num_train_steps)
+    print('Eager loop: %.1f steps/sec, compiled loop: %.1f steps/sec (%.1fx)' % (
+        eager_steps_per_sec, compiled_steps_per_sec, compiled_steps_per_sec / eager_steps_per_sec))
+    train_acc_metric.reset_states()
+
+train_loop = TrainLoop(model, optimizer, loss_object, train_acc_metric, train.element_spec)
+
+# validate epoch N on a weight snapshot in the background while epoch N+1 trains
+overlap_validation = True
+
 device = '/gpu:0' if tf.config.list_physical_devices('GPU') else '/cpu:0'
 # Iterate over epochs.
 epochs = 10
 epochs_val_losses, epochs_train_losses = [], []
-for epoch in range(epochs):
-    print('Start of epoch %d' % (epoch,))
 
-    with tf.device(device_name=device):
-        losses_train = train_data_for_one_epoch(model)
-
-    train_acc = train_acc_metric.result()
-    losses_val = perform_validation(model)
-    val_acc = val_acc_metric.result()
 
-    losses_train_mean = np.mean(losses_train)
-    losses_val_mean = np.mean(losses_val)
+def report_epoch(epoch, losses_train_mean, train_acc, losses_val_mean, val_acc):
     epochs_val_losses.append(losses_val_mean)
     epochs_train_losses.append(losses_train_mean)
-
     print('\n Epoch %s: Train loss: %.4f  Validation Loss: %.4f, Train Accuracy: %.4f, Validation Accuracy %.4f' % (
         epoch, float(losses_train_mean), float(losses_val_mean), float(train_acc), float(val_acc)))
 
+
+if overlap_validation:
+    # bucket the validation batches so the smaller final batch does not trace a second graph
+    validator = BackgroundValidator(model, test, loss_object, tf.keras.metrics.SparseCategoricalAccuracy(),
+                                    bucket_sizes=[batch_size])
+    pending_validation = None
+    train_results = {}
+
+for epoch in range(epochs):
+    print('Start of epoch %d' % (epoch,))
+
+    with tf.device(device_name=device):
+        if use_compiled_loop:
+            losses_train = [train_loop.train_epoch(train)]
+        else:
+            losses_train = train_data_for_one_epoch(model)
+
+    train_acc = float(train_acc_metric.result())
+    losses_train_mean = np.mean(losses_train)
     train_acc_metric.reset_states()
+
+    if overlap_validation:
+        # by now the previous epoch's validation has had a whole training epoch to finish
+        if pending_validation is not None:
+            val_epoch, losses_val_mean, val_acc = pending_validation.result()
+            report_epoch(val_epoch, *train_results.pop(val_epoch), losses_val_mean, val_acc)
+        train_results[epoch] = (losses_train_mean, train_acc)
+        pending_validation = validator.submit(epoch, model)
+        continue
+
+    losses_val = perform_validation(model)
+    val_acc = val_acc_metric.result()
+    report_epoch(epoch, losses_train_mean, train_acc, np.mean(losses_val), val_acc)
     val_acc_metric.reset_states()
 
+if overlap_validation:
+    val_epoch, losses_val_mean, val_acc = pending_validation.result()
+    report_epoch(val_epoch, *train_results.pop(val_epoch), losses_val_mean, val_acc)
+    validator.shutdown()
+
 
 def plot_metrics(train_metric, val_metric, metric_name, title, ylim=5):
     plt.title(title)
@@ -131,19 +180,14 @@ def display_images(image, predictions, labels, title, n):
     image = np.reshape(image, [28, 28 * n])
     plt.imshow(image)
 
-test_inputs = test_data.batch(batch_size=1000001)
-x_batches, y_pred_batches, y_true_batches = [], [], []
-
-for x, y in test_inputs:
-  y_pred = model(x)
-  y_pred_batches = y_pred.numpy()
-  y_true_batches = y.numpy()
-  x_batches = x.numpy()
+# stream the test set in fixed-size batches: sample 10 random examples on the fly and accumulate
+# the confusion matrix, peak memory does not depend on the size of the test set
+(images_to_plot, y_pred_to_plot, y_true_to_plot), confusion, per_class_accuracy = predict_streaming(
+    model, test, num_classes=len(class_names), sample_size=10)
 
-indexes = np.random.choice(len(y_pred_batches), size=10)
-images_to_plot = x_batches[indexes]
-y_pred_to_plot = y_pred_batches[indexes]
-y_true_to_plot = y_true_batches[indexes]
+print(confusion)
+for name, accuracy in zip(class_names, per_class_accuracy):
+    print('%s: %.4f' % (name, accuracy))
 
 y_pred_labels = [class_names[np.argmax(sel_y_pred)] for sel_y_pred in y_pred_to_plot]
 y_true_labels = [class_names[sel_y_true] for sel_y_true in y_true_to_plot]
@@ -1,5 +1,7 @@
 import tensorflow as tf
 
+from utility import traced_function
+
 a = tf.Variable(1.0)
 b = tf.Variable(2.0)
 
@@ -65,4 +67,24 @@ def f(x):
     tf.print("Executed with", x)
 for i in range(5):
     f(2)
-f(3)
\ No newline at end of file
+f(3)
+
+
+# count the traces and warn once a function has been traced more than twice
+@traced_function(max_traces=2)
+def f(x):
+    tf.print("Executed with", x)
+for i in range(5):
+    f(2)
+f(3)
+f(4)
+print(f.trace_count, f.trace_signatures)
+
+
+# pad tensor inputs up to a bucket, batches of 3 and 7 rows both run the graph traced for 8 rows
+@traced_function(bucket_sizes=[8, 16])
+def row_sums(x):
+    return tf.reduce_sum(x, axis=1)
+print(row_sums(tf.ones([3, 4])))
+print(row_sums(tf.ones([7, 4])))
+print(row_sums.trace_count)
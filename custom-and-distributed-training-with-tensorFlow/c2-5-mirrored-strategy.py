@@ -4,6 +4,8 @@ tfds.disable_progress_bar()
 
 import os
 
+from utility import snapshot_cache
+
 # Load the dataset we'll use for this lab
 datasets, info = tfds.load(name='mnist', with_info=True, as_supervised=True, data_dir='./data')
 mnist_train, mnist_test = datasets['train'], datasets['test']
@@ -27,8 +29,17 @@ def scale(image, label):
     image /= 255
     return image, label
 
+# Keep the scaled training set in sharded files on local disk instead of in RAM with `.cache()`,
+# later epochs and later runs read it back from there
+USE_SNAPSHOT_CACHE = True
+SNAPSHOT_DIR = os.path.join('./data', 'snapshot', 'mnist_train')
+
 # Set up the train and eval data set
-train_dataset = mnist_train.map(scale).cache().shuffle(BUFFER_SIZE).batch(BATCH_SIZE)
+if USE_SNAPSHOT_CACHE:
+    train_dataset = snapshot_cache(mnist_train.map(scale, num_parallel_calls=tf.data.AUTOTUNE), SNAPSHOT_DIR)
+else:
+    train_dataset = mnist_train.map(scale).cache()
+train_dataset = train_dataset.shuffle(BUFFER_SIZE).batch(BATCH_SIZE)
 eval_dataset = mnist_test.map(scale).batch(BATCH_SIZE)
 
 # Use for Mirrored Strategy -- comment out `with strategy.scope():` and deindent for no strategy
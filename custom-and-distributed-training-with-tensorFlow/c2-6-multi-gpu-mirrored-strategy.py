@@ -1,17 +1,44 @@
 import tensorflow as tf
 import numpy as np
 import os
+import time
+
+from utility import PersistentCompilationCache, StepCheckpointer, traced_function
 
 # Note that it generally has a minimum of 8 cores, but if your GPU has
 # less, you need to set this. In this case one of my GPUs has 4 cores
 os.environ["TF_MIN_GPU_MULTIPROCESSOR_COUNT"] = "4"
 
-# If the list of devices is not specified in the
-# `tf.distribute.MirroredStrategy` constructor, it will be auto-detected.
-# If you have *different* GPUs in your system, you probably have to set up cross_device_ops like this
-strategy = tf.distribute.MirroredStrategy(cross_device_ops=tf.distribute.HierarchicalCopyAllReduce())
+# XLA-compile the per-replica steps. Set COMPILATION_CACHE_DIR to keep the compiled executables on
+# local disk, so a restarted process skips the compilation. The cache has to exist before the first compile.
+USE_XLA = False
+COMPILATION_CACHE_DIR = None  # e.g. './xla_cache'
+# TF reads TF_XLA_FLAGS when the runtime starts (the first tf.config or strategy call), so this has to come first
+compilation_cache = PersistentCompilationCache(COMPILATION_CACHE_DIR) if COMPILATION_CACHE_DIR and USE_XLA else None
+
+# On a machine without GPUs, split the CPU into this many logical devices so there are several replicas
+NUM_VIRTUAL_CPUS = 0
+
+if NUM_VIRTUAL_CPUS and not tf.config.list_physical_devices('GPU'):
+  cpu = tf.config.list_physical_devices('CPU')[0]
+  tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * NUM_VIRTUAL_CPUS)
+  strategy = tf.distribute.MirroredStrategy(devices=['/cpu:{}'.format(i) for i in range(NUM_VIRTUAL_CPUS)],
+                                            cross_device_ops=tf.distribute.ReductionToOneDevice())
+else:
+  # If the list of devices is not specified in the
+  # `tf.distribute.MirroredStrategy` constructor, it will be auto-detected.
+  # If you have *different* GPUs in your system, you probably have to set up cross_device_ops like this
+  strategy = tf.distribute.MirroredStrategy(cross_device_ops=tf.distribute.HierarchicalCopyAllReduce())
 print ('Number of devices: {}'.format(strategy.num_replicas_in_sync))
 
+# apply_gradients calls merge_call, which MirroredStrategy only allows inside the nested jit-compiled
+# step when every replica is a GPU. On CPU replicas (the NUM_VIRTUAL_CPUS mode too) the steps stay uncompiled.
+xla_enabled = USE_XLA and all('GPU' in device.upper() for device in strategy.extended.worker_devices)
+if USE_XLA and not xla_enabled:
+  print('USE_XLA needs every replica on a GPU, running without XLA')
+  # only jit-compiled functions write to the cache, nothing to record without XLA
+  compilation_cache = None
+
 # Get the data
 fashion_mnist = tf.keras.datasets.fashion_mnist
 (train_images, train_labels), (test_images, test_labels) = fashion_mnist.load_data()
@@ -31,6 +58,10 @@ test_images = test_images / np.float32(255)
 BUFFER_SIZE = len(train_images)
 BATCH_SIZE_PER_REPLICA = 64
 GLOBAL_BATCH_SIZE = BATCH_SIZE_PER_REPLICA * strategy.num_replicas_in_sync
+# Gradient accumulation: sum the gradients of K micro-batches in replica-local variables and do one
+# all-reduce + apply_gradients per K steps. The effective global batch is GLOBAL_BATCH_SIZE * K.
+ACCUMULATION_STEPS = 1
+EFFECTIVE_BATCH_SIZE = GLOBAL_BATCH_SIZE * ACCUMULATION_STEPS
 
 # Create Datasets from the batches
 train_dataset = tf.data.Dataset.from_tensor_slices((train_images, train_labels)).shuffle(BUFFER_SIZE).batch(GLOBAL_BATCH_SIZE)
@@ -69,7 +100,8 @@ with strategy.scope():
         # Tensor("replica_1/sparse_categorical_crossentropy/weighted_loss/Mul:0", shape=(48,), dtype=float32, device=/job:localhost/replica:0/task:0/device:GPU:1)
         # Note in particular that replica_0 isn't named in the weighted_loss -- the first is unnamed, the second is replica_1 etc
         print(per_example_loss)
-        return tf.nn.compute_average_loss(per_example_loss, global_batch_size=GLOBAL_BATCH_SIZE)
+        # Divide by the effective batch so the K accumulated gradients add up to the mean over all of it
+        return tf.nn.compute_average_loss(per_example_loss, global_batch_size=EFFECTIVE_BATCH_SIZE)
 
     # We'll just reduce by getting the average of the losses
     test_loss = tf.keras.metrics.Mean(name='test_loss')
@@ -80,10 +112,20 @@ with strategy.scope():
     optimizer = tf.keras.optimizers.Adam()
     # Create the model within the scope
     model = create_model()
+    if ACCUMULATION_STEPS > 1:
+      # the accumulators need the model variables to exist already
+      model.build((None, 28, 28, 1))
+      # ON_READ variables are replica-local: each replica adds to its own copy, nothing is synced on write
+      accumulated_gradients = [
+          tf.Variable(tf.zeros_like(variable), trainable=False,
+                      synchronization=tf.VariableSynchronization.ON_READ,
+                      aggregation=tf.VariableAggregation.SUM)
+          for variable in model.trainable_variables]
 
 # `run` replicates the provided computation and runs it
 # with the distributed input.
-@tf.function
+# The partial last batch of an epoch traces a second graph, anything beyond that is unexpected retracing.
+@traced_function(max_traces=2, compilation_cache=compilation_cache)
 def distributed_train_step(dataset_inputs):
   per_replica_losses = strategy.run(train_step, args=(dataset_inputs,))
   #tf.print(per_replica_losses.values)
@@ -99,10 +141,53 @@ def train_step(inputs):
   train_accuracy.update_state(labels, predictions)
   return loss
 
+# Run up to `num_steps` train steps inside one tf.function, the loss sum stays on device.
+# This removes the per-step Python dispatch and the device-to-host sync of `total_loss += ...`.
+@traced_function(max_traces=1, compilation_cache=compilation_cache)
+def distributed_train_steps(iterator, num_steps):
+  total_loss = tf.constant(0.0)
+  steps_run = tf.constant(0)
+  for _ in tf.range(num_steps):
+    # the last call of an epoch may run fewer steps
+    optional_inputs = iterator.get_next_as_optional()
+    if not optional_inputs.has_value():
+      break
+    per_replica_losses = strategy.run(train_step, args=(optional_inputs.get_value(),))
+    total_loss += strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_losses, axis=None)
+    steps_run += 1
+  return total_loss, steps_run
+
+@traced_function(max_traces=2, compilation_cache=compilation_cache)
+def distributed_accumulate_step(dataset_inputs):
+  per_replica_losses = strategy.run(accumulate_step, args=(dataset_inputs,))
+  return strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_losses, axis=None)
+
+def accumulate_step(inputs):
+  images, labels = inputs
+  with tf.GradientTape() as tape:
+    predictions = model(images, training=True)
+    loss = compute_loss(labels, predictions)
+  gradients = tape.gradient(loss, model.trainable_variables)
+  for accumulator, gradient in zip(accumulated_gradients, gradients):
+    accumulator.assign_add(gradient)
+  train_accuracy.update_state(labels, predictions)
+  return loss
+
+@traced_function(max_traces=1, compilation_cache=compilation_cache)
+def distributed_apply_step(scale):
+  strategy.run(apply_step, args=(scale,))
+
+def apply_step(scale):
+  # in replica context the accumulators read as the local sums; apply_gradients all-reduces them once
+  optimizer.apply_gradients(zip([tf.identity(accumulator) * scale for accumulator in accumulated_gradients],
+                                model.trainable_variables))
+  for accumulator in accumulated_gradients:
+    accumulator.assign(tf.zeros_like(accumulator))
+
 #######################
 # Test Steps Functions
 #######################
-@tf.function
+@traced_function(max_traces=2, compilation_cache=compilation_cache)
 def distributed_test_step(dataset_inputs):
   return strategy.run(test_step, args=(dataset_inputs,))
 
@@ -113,15 +198,107 @@ def test_step(inputs):
   test_loss.update_state(t_loss)
   test_accuracy.update_state(labels, predictions)
 
-EPOCHS = 10
-for epoch in range(EPOCHS):
-  # Do Training
+if xla_enabled:
+  train_step = tf.function(train_step, jit_compile=True)
+  test_step = tf.function(test_step, jit_compile=True)
+
+# Number of train steps per call of distributed_train_steps, 1 keeps the per-batch Python loop
+STEPS_PER_CALL = 1
+# Time one epoch of the per-batch loop against one epoch of the in-graph loop before training
+BENCHMARK_STEPS_PER_CALL = False
+
+# Save model, optimizer, metrics and the iterator position every SAVE_EVERY_STEPS steps, and resume
+# from the latest checkpoint at the exact step after a restart. Saves land on accumulation boundaries.
+CHECKPOINT_DIR = None  # e.g. './checkpoints/c2-6'
+SAVE_EVERY_STEPS = 100 * ACCUMULATION_STEPS
+# created after the benchmark below, so benchmark steps are not counted as training progress
+checkpointer = None
+
+def end_steps(num_steps):
+  if checkpointer is not None:
+    checkpointer.end_steps(num_steps)
+
+def train_epoch_per_step(iterator, first_step=0):
+  total_loss = 0.0
+  # counted from the start of the epoch, so a resumed epoch keeps its accumulation boundaries
+  num_batches = first_step
+  for batch in iterator:
+    if ACCUMULATION_STEPS > 1:
+      total_loss += distributed_accumulate_step(batch)
+      num_batches += 1
+      if num_batches % ACCUMULATION_STEPS == 0:
+        distributed_apply_step(tf.constant(1.0))
+    else:
+      total_loss += distributed_train_step(batch)
+      num_batches += 1
+    end_steps(1)
+  leftover = num_batches % ACCUMULATION_STEPS
+  if ACCUMULATION_STEPS > 1 and leftover:
+    # flush the leftover micro-batches at the end of the epoch. Their losses were divided by the
+    # effective batch of K micro-batches, scale by K / leftover so the update is their mean
+    distributed_apply_step(tf.constant(ACCUMULATION_STEPS / leftover))
+  return total_loss, num_batches - first_step
+
+def train_epoch_in_graph(iterator, steps_per_call):
+  num_steps = tf.constant(steps_per_call)
   total_loss = 0.0
   num_batches = 0
-  for batch in train_dist_dataset:
-    total_loss += distributed_train_step(batch)
-    num_batches += 1
-  train_loss = total_loss / num_batches
+  while True:
+    loss_sum, steps_run = distributed_train_steps(iterator, num_steps)
+    total_loss += loss_sum
+    # the only host sync, once per call
+    steps_run = int(steps_run)
+    num_batches += steps_run
+    end_steps(steps_run)
+    if steps_run < steps_per_call:
+      return total_loss, num_batches
+
+def train_epoch(epoch):
+  iterator = iter(train_dist_dataset)
+  # when resuming, the iterator is restored to the saved position of this epoch
+  first_step = checkpointer.begin_epoch(epoch, iterator) if checkpointer is not None else 0
+  if STEPS_PER_CALL > 1 and ACCUMULATION_STEPS == 1:
+    return train_epoch_in_graph(iterator, STEPS_PER_CALL)
+  return train_epoch_per_step(iterator, first_step)
+
+if BENCHMARK_STEPS_PER_CALL:
+  # the benchmark trains the real model and optimizer, snapshot them to restore the untrained state after
+  with strategy.scope():
+    model.build((None, 28, 28, 1))
+    optimizer.build(model.trainable_variables)
+  initial_model_weights = model.get_weights()
+  initial_optimizer_state = [variable.numpy() for variable in optimizer.variables]
+  benchmark_steps_per_call = max(STEPS_PER_CALL, 50)
+  steps_per_sec = []
+  for run_epoch in [lambda: train_epoch_per_step(iter(train_dist_dataset)),
+                    lambda: train_epoch_in_graph(iter(train_dist_dataset), benchmark_steps_per_call)]:
+    run_epoch()  # warm up: trace and fill the pipeline
+    start = time.perf_counter()
+    total_loss, num_batches = run_epoch()
+    float(total_loss)
+    steps_per_sec.append(num_batches / (time.perf_counter() - start))
+  print('{} replicas: per step {:.1f} steps/sec, {} steps per call {:.1f} steps/sec ({:.2f}x)'.format(
+      strategy.num_replicas_in_sync, steps_per_sec[0], benchmark_steps_per_call, steps_per_sec[1],
+      steps_per_sec[1] / steps_per_sec[0]))
+  model.set_weights(initial_model_weights)
+  for variable, value in zip(optimizer.variables, initial_optimizer_state):
+    variable.assign(value)
+  # the gradient accumulators are already zero, every benchmark epoch ends with a flush
+  train_accuracy.reset_states()
+
+if CHECKPOINT_DIR:
+  checkpointer = StepCheckpointer(CHECKPOINT_DIR, save_every=SAVE_EVERY_STEPS, model=model, optimizer=optimizer,
+                                  train_accuracy=train_accuracy)
+
+EPOCHS = 10
+first_epoch = int(checkpointer.epoch) if checkpointer is not None else 0
+for epoch in range(first_epoch, EPOCHS):
+  # Do Training
+  total_loss, num_batches = train_epoch(epoch)
+  if checkpointer is not None:
+    checkpointer.end_epoch()
+  # each step's loss was divided by the effective batch, scale back to a per-batch mean
+  train_loss = total_loss * ACCUMULATION_STEPS / num_batches
   # Do Testing
   for batch in test_dist_dataset:
     distributed_test_step(batch)
@@ -129,4 +306,10 @@ for epoch in range(EPOCHS):
   print (template.format(epoch+1, train_loss, train_accuracy.result()*100, test_loss.result(), test_accuracy.result()*100))
   test_loss.reset_states()
   train_accuracy.reset_states()
-  test_accuracy.reset_states()
\ No newline at end of file
+  test_accuracy.reset_states()
+
+if checkpointer is not None:
+  checkpointer.wait()
+
+if compilation_cache is not None:
+  compilation_cache.report()
@@ -1,7 +1,11 @@
 import os
 import random
+import time
 import tensorflow as tf
 
+from utility import (FLOWERS_CLASSES, LAMB, DataEcho, StepCheckpointer, WarmupLinearScaling,
+                     convert_to_uint8_tfrecords, get_batched_dataset, get_batched_uint8_dataset, traced_function)
+
 AUTO = tf.data.experimental.AUTOTUNE
 
 # Detect hardware
@@ -27,13 +31,36 @@ IMAGE_SIZE = [SIZE, SIZE]
 
 GCS_PATTERN = 'gs://flowers-public/tfrecords-jpeg-{}x{}/*.tfrec'.format(IMAGE_SIZE[0], IMAGE_SIZE[1])
 
-BATCH_SIZE = 128  # On TPU in Keras, this is the per-core batch size. The global batch size is 8x this.
+BATCH_SIZE = 128  # base global batch size, the learning rate of the default Adam setup is tuned for it
+# The pipeline batches GLOBAL_BATCH_SIZE examples per step and experimental_distribute_dataset splits every
+# batch across the replicas, so each core sees GLOBAL_BATCH_SIZE / num_replicas_in_sync.
+# compute_loss divides by GLOBAL_BATCH_SIZE.
+GLOBAL_BATCH_SIZE = BATCH_SIZE
+
+# Large-batch mode: a bigger global batch trained with LAMB, the learning rate scaled linearly with the
+# batch size and a linear warmup over the first WARMUP_EPOCHS. c2-12-large-batch-scaling.py has the
+# time-to-accuracy experiment for batch sizes from 128 up to 8k.
+LARGE_BATCH = False
+LARGE_GLOBAL_BATCH_SIZE = 1024
+BASE_LEARNING_RATE = 0.001  # tuned at a global batch of BATCH_SIZE
+WARMUP_EPOCHS = 5
+EPOCHS = 40
+if LARGE_BATCH:
+  GLOBAL_BATCH_SIZE = LARGE_GLOBAL_BATCH_SIZE
 
 VALIDATION_SPLIT = 0.2
-CLASSES = ['daisy', 'dandelion', 'roses', 'sunflowers', 'tulips'] # do not change, maps to the labels in the data (folder names)
+CLASSES = FLOWERS_CLASSES # do not change, maps to the labels in the data (folder names)
+
+# Save model, optimizer, metrics and the iterator position every SAVE_EVERY_STEPS steps and resume at the
+# exact step after a preemption. On TPU the checkpoints have to go to a GCS bucket.
+CHECKPOINT_DIR = None  # e.g. 'gs://<your-bucket>/checkpoints/flowers'
+SAVE_EVERY_STEPS = 10
 
 # splitting data files between training and validation
 filenames = tf.io.gfile.glob(GCS_PATTERN)
+if CHECKPOINT_DIR:
+  # a resumed run has to see the same split and file order as the run it resumes
+  random.seed(0)
 random.shuffle(filenames)
 
 split = int(len(filenames) * VALIDATION_SPLIT)
@@ -41,53 +68,59 @@ training_filenames = filenames[split:]
 validation_filenames = filenames[:split]
 print("Pattern matches {} data files. Splitting dataset into {} training files and {} validation files".format(len(filenames), len(training_filenames), len(validation_filenames)))
 
-validation_steps = int(3670 // len(filenames) * len(validation_filenames)) // BATCH_SIZE
-steps_per_epoch = int(3670 // len(filenames) * len(training_filenames)) // BATCH_SIZE
-print("With a batch size of {}, there will be {} batches per training epoch and {} batch(es) per validation run.".format(BATCH_SIZE, steps_per_epoch, validation_steps))
-
-def read_tfrecord(example):
-    features = {
-        "image": tf.io.FixedLenFeature([], tf.string), # tf.string means bytestring
-        "class": tf.io.FixedLenFeature([], tf.int64),  # shape [] means scalar
-        "one_hot_class": tf.io.VarLenFeature(tf.float32),
-    }
-    example = tf.io.parse_single_example(example, features)
-    image = example['image']
-    class_label = example['class']
-    image = tf.image.decode_jpeg(image, channels=3)
-    image = tf.image.resize(image, [224, 224])
-    image = tf.cast(image, tf.float32) / 255.0  # convert image to floats in [0, 1] range
-    class_label = tf.cast(class_label, tf.int32)
-    return image, class_label
-
-def load_dataset(filenames):
-  # read from TFRecords. For optimal performance, use "interleave(tf.data.TFRecordDataset, ...)"
-  # to read from multiple TFRecord files at once and set the option experimental_deterministic = False
-  # to allow order-altering optimizations.
-
-  option_no_order = tf.data.Options()
-  option_no_order.experimental_deterministic = False
-
-  dataset = tf.data.Dataset.from_tensor_slices(filenames)
-  dataset = dataset.with_options(option_no_order)
-  dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=16, num_parallel_calls=AUTO) # faster
-  dataset = dataset.map(read_tfrecord, num_parallel_calls=AUTO)
-  return dataset
-
-def get_batched_dataset(filenames):
-  dataset = load_dataset(filenames)
-  dataset = dataset.shuffle(2048)
-  dataset = dataset.batch(BATCH_SIZE, drop_remainder=False) # drop_remainder will be needed on TPU
-  dataset = dataset.prefetch(AUTO) # prefetch next batch while training (autotune prefetch buffer size)
-  return dataset
+validation_steps = int(3670 // len(filenames) * len(validation_filenames)) // GLOBAL_BATCH_SIZE
+steps_per_epoch = int(3670 // len(filenames) * len(training_filenames)) // GLOBAL_BATCH_SIZE
+print("With a batch size of {}, there will be {} batches per training epoch and {} batch(es) per validation run.".format(GLOBAL_BATCH_SIZE, steps_per_epoch, validation_steps))
+
+# Parse and decode whole batches of records (one parse_example per batch) instead of one record at a time.
+# The pipeline itself lives in utility.py, c2-11-flowers-input-pipeline.py benchmarks both modes offline.
+BATCH_PARSE = False
+
+# Decode and resize every JPEG once into fixed-size uint8 records (224x224x3 raw bytes + label) and
+# train from those, later epochs only read and cast. On TPU the cache has to be on GCS.
+UINT8_CACHE_DIR = None  # e.g. 'gs://<your-bucket>/flowers-uint8-224x224'
+
+if UINT8_CACHE_DIR:
+  # converts only if the cache has no completion marker yet
+  convert_to_uint8_tfrecords(filenames, UINT8_CACHE_DIR)
+  # the converted shards keep their names, so the same train/validation split applies
+  training_filenames = [os.path.join(UINT8_CACHE_DIR, os.path.basename(f)) for f in training_filenames]
+  validation_filenames = [os.path.join(UINT8_CACHE_DIR, os.path.basename(f)) for f in validation_filenames]
+
+def get_pipeline(filenames):
+  if UINT8_CACHE_DIR:
+    return get_batched_uint8_dataset(filenames, GLOBAL_BATCH_SIZE)
+  return get_batched_dataset(filenames, GLOBAL_BATCH_SIZE, batch_parse=BATCH_PARSE)
+
+# Data echoing: when the decode can't keep up with the model, repeat every decoded training batch
+# ECHO_FACTOR times, each copy with a fresh random flip. With ADAPTIVE_ECHO the factor goes up or down
+# after every epoch depending on how much of the epoch was spent waiting for input (per-step loop only).
+ECHO_FACTOR = 1
+ADAPTIVE_ECHO = False
+MAX_ECHO_FACTOR = 4
+
+def random_flip(images, labels):
+  return tf.image.random_flip_left_right(images), labels
+
+# the input pipeline runs on the TPU host, so the echo factor has to live on its CPU
+data_echo = DataEcho(ECHO_FACTOR, MAX_ECHO_FACTOR, augment_fn=random_flip,
+                     device='/job:worker/replica:0/task:0/device:CPU:0') if ECHO_FACTOR > 1 or ADAPTIVE_ECHO else None
+
+# Build the pipelines once and keep iterating them across epochs. The training stream repeats and is
+# read for steps_per_epoch steps per epoch, so its shuffle buffer and prefetch stay warm between epochs
+# instead of being rebuilt and refilled from empty every epoch. The validation dataset doesn't repeat,
+# every epoch iterates it once from the start so each validation example is counted exactly once.
+PERSISTENT_DATASET = True
 
 def get_training_dataset():
-  dataset = get_batched_dataset(training_filenames)
-  dataset = strategy.experimental_distribute_dataset(dataset)
+  dataset = get_pipeline(training_filenames)
+  if data_echo is not None:
+    dataset = data_echo(dataset)
+  dataset = strategy.experimental_distribute_dataset(dataset.repeat())
   return dataset
 
 def get_validation_dataset():
-  dataset = get_batched_dataset(validation_filenames)
+  dataset = get_pipeline(validation_filenames)
   dataset = strategy.experimental_distribute_dataset(dataset)
   return dataset
 
@@ -144,10 +177,13 @@ with strategy.scope():
         reduction=tf.keras.losses.Reduction.NONE)
 
 
+    # Every replica divides its summed loss by the global batch, not by its own share of it, so the
+    # gradients summed across replicas in apply_gradients are the gradient of the global mean. The
+    # learning rate schedule of the large-batch mode relies on that.
     def compute_loss(labels, predictions):
         per_example_loss = loss_object(labels, predictions)
         return tf.nn.compute_average_loss(per_example_loss,
-                                          global_batch_size=BATCH_SIZE * strategy.num_replicas_in_sync)
+                                          global_batch_size=GLOBAL_BATCH_SIZE)
 
 
     test_loss = tf.keras.metrics.Mean(name='test_loss')
@@ -157,10 +193,18 @@ with strategy.scope():
     test_accuracy = tf.keras.metrics.SparseCategoricalAccuracy(
         name='test_accuracy')
 
-    optimizer = tf.keras.optimizers.Adam()
+    if LARGE_BATCH:
+        learning_rate = WarmupLinearScaling(BASE_LEARNING_RATE, base_batch_size=BATCH_SIZE,
+                                            global_batch_size=GLOBAL_BATCH_SIZE,
+                                            warmup_steps=WARMUP_EPOCHS * steps_per_epoch,
+                                            total_steps=EPOCHS * steps_per_epoch)
+        optimizer = LAMB(learning_rate=learning_rate)
+    else:
+        optimizer = tf.keras.optimizers.Adam()
 
 
-    @tf.function
+    # drop_remainder=False, so the partial last batch traces a second graph; more than that is retracing
+    @traced_function(max_traces=2)
     def distributed_train_step(dataset_inputs):
         per_replica_losses = strategy.run(train_step, args=(dataset_inputs,))
         print(per_replica_losses)
@@ -168,7 +212,24 @@ with strategy.scope():
                                axis=None)
 
 
-    @tf.function
+    # Run up to `num_steps` train steps in one tf.function, the loss sum stays on the device.
+    # Going back and forth between TPU and host is expensive, see STEPS_PER_CALL below.
+    @traced_function(max_traces=1)
+    def distributed_train_steps(iterator, num_steps):
+        total_loss = tf.constant(0.0)
+        steps_run = tf.constant(0)
+        for _ in tf.range(num_steps):
+            # the last call of an epoch may run fewer steps
+            optional_inputs = iterator.get_next_as_optional()
+            if not optional_inputs.has_value():
+                break
+            per_replica_losses = strategy.run(train_step, args=(optional_inputs.get_value(),))
+            total_loss += strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_losses, axis=None)
+            steps_run += 1
+        return total_loss, steps_run
+
+
+    @traced_function(max_traces=2)
     def distributed_test_step(dataset_inputs):
         strategy.run(test_step, args=(dataset_inputs,))
 
@@ -198,31 +259,86 @@ with strategy.scope():
         test_accuracy.update_state(labels, predictions)
 
 
-EPOCHS = 40
+# Number of train steps per call of distributed_train_steps, 1 keeps the per-batch Python loop
+STEPS_PER_CALL = 1
+
+
+input_wait_seconds = 0.0
+
+def train_steps(iterator, num_steps):
+  # run exactly `num_steps` train steps, STEPS_PER_CALL of them per tf.function call
+  global input_wait_seconds
+  total_loss = 0.0
+  while num_steps > 0:
+    if STEPS_PER_CALL > 1:
+      loss_sum, steps_run = distributed_train_steps(iterator, tf.constant(min(STEPS_PER_CALL, num_steps)))
+      steps_run = int(steps_run)
+    else:
+      start = time.perf_counter()
+      batch = next(iterator)
+      input_wait_seconds += time.perf_counter() - start
+      loss_sum, steps_run = distributed_train_step(batch), 1
+    total_loss += loss_sum
+    num_steps -= steps_run
+    if checkpointer is not None:
+      checkpointer.end_steps(steps_run)
+  return total_loss
+
+
 with strategy.scope():
-  for epoch in range(EPOCHS):
+  checkpointer = StepCheckpointer(CHECKPOINT_DIR, save_every=SAVE_EVERY_STEPS, model=model, optimizer=optimizer,
+                                  train_accuracy=train_accuracy) if CHECKPOINT_DIR else None
+  first_epoch = int(checkpointer.epoch) if checkpointer is not None else 0
+  if PERSISTENT_DATASET:
+    train_iterator = iter(get_training_dataset())
+    validation_dataset = get_validation_dataset()
+  for epoch in range(first_epoch, EPOCHS):
     # TRAINING LOOP
-    total_loss = 0.0
-    num_batches = 0
-    for x in get_training_dataset():
-      total_loss += distributed_train_step(x)
-      num_batches += 1
-    train_loss = total_loss / num_batches
+    if not PERSISTENT_DATASET:
+      train_iterator = iter(get_training_dataset())
+      validation_dataset = get_validation_dataset()
+    first_step = 0
+    if checkpointer is not None:
+      # when resuming, the iterator is restored to the saved position of this epoch
+      first_step = checkpointer.begin_epoch(epoch, train_iterator)
+    num_batches = steps_per_epoch - first_step
+
+    total_loss, first_step_latency = 0.0, 0.0
+    input_wait_seconds = 0.0
+    epoch_start = time.perf_counter()
+    # a run can be preempted after its last step was saved but before the epoch ended
+    if num_batches > 0:
+      # time the first step of the epoch on its own, it includes waiting for the input pipeline
+      start = time.perf_counter()
+      total_loss = train_steps(train_iterator, 1)
+      float(total_loss)
+      first_step_latency = time.perf_counter() - start
+      total_loss += train_steps(train_iterator, num_batches - 1)
+    train_loss = total_loss / max(num_batches, 1)
+    if ADAPTIVE_ECHO and STEPS_PER_CALL == 1:
+      float(train_loss)
+      wait_fraction, echo_factor = data_echo.update(input_wait_seconds, time.perf_counter() - epoch_start)
+      print('Waited for input {:.0%} of the epoch, echo factor is now {}'.format(wait_fraction, echo_factor))
+    if checkpointer is not None:
+      checkpointer.end_epoch()
 
     # TESTING LOOP
-    for x in get_validation_dataset():
+    for x in validation_dataset:
       distributed_test_step(x)
 
     template = ("Epoch {}, Loss: {:.2f}, Accuracy: {:.2f}, Test Loss: {:.2f}, "
-                "Test Accuracy: {:.2f}")
+                "Test Accuracy: {:.2f}, First step: {:.3f}s")
     print (template.format(epoch+1, train_loss,
                            train_accuracy.result()*100, test_loss.result() / strategy.num_replicas_in_sync,
-                           test_accuracy.result()*100))
+                           test_accuracy.result()*100, first_step_latency))
 
     test_loss.reset_states()
     train_accuracy.reset_states()
     test_accuracy.reset_states()
 
+  if checkpointer is not None:
+    checkpointer.wait()
+
 # @title display utilities [RUN ME]
 import matplotlib.pyplot as plt
 
@@ -305,7 +421,7 @@ def display_training_curves(training, validation, title, subplot):
     ax.legend(['train', 'valid.'])
 
 inference_model = model
-some_flowers, some_labels = dataset_to_numpy_util(load_dataset(validation_filenames), 8*20)
+some_flowers, some_labels = dataset_to_numpy_util(get_pipeline(validation_filenames).unbatch(), 8*20)
 
 import numpy as np
 # randomize the input so that you can execute multiple times to change results
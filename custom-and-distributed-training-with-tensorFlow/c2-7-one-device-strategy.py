@@ -2,6 +2,8 @@ import tensorflow as tf
 import tensorflow_hub as hub
 import tensorflow_datasets as tfds
 
+from utility import cache_features, decode_example, feature_dataset, make_train_batches
+
 tfds.disable_progress_bar()
 
 # choose a device type such as CPU or GPU
@@ -19,9 +21,16 @@ IMAGE_SIZE = (pixels, pixels)
 BATCH_SIZE = 32
 print("Using {} with input size {}".format(MODULE_HANDLE, IMAGE_SIZE))
 
+# shuffle the encoded training images and the file shards, decode after the shuffle
+ENCODED_SHUFFLE = True
+# print the shuffle buffer memory and the time to the first batch (fills the buffer one extra time)
+BENCHMARK_SHUFFLE = False
+
 splits = ['train[:80%]', 'train[80%:90%]', 'train[90%:]']
-(train_examples, validation_examples, test_examples), info = tfds.load('cats_vs_dogs', with_info=True,
-                                                                       as_supervised=True, split=splits)
+(validation_examples, test_examples), info = tfds.load('cats_vs_dogs', with_info=True,
+                                                       as_supervised=True, split=splits[1:])
+train_examples = tfds.load('cats_vs_dogs', as_supervised=True, split=splits[0], shuffle_files=ENCODED_SHUFFLE,
+                           decoders={'image': tfds.decode.SkipDecoding()} if ENCODED_SHUFFLE else None)
 num_examples = info.splits['train'].num_examples
 num_classes = info.features['label'].num_classes
 
@@ -31,7 +40,8 @@ def format_image(image, label):
     return image, label
 
 
-train_batches = train_examples.shuffle(num_examples // 4).map(format_image).batch(BATCH_SIZE).prefetch(1)
+train_batches = make_train_batches(train_examples, format_image, BATCH_SIZE, num_examples // 4,
+                                   encoded=ENCODED_SHUFFLE, benchmark=BENCHMARK_SHUFFLE)
 validation_batches = validation_examples.map(format_image).batch(BATCH_SIZE).prefetch(1)
 test_batches = test_examples.map(format_image).batch(1)
 
@@ -41,6 +51,11 @@ for image_batch, label_batch in train_batches.take(1):
 print(image_batch.shape)
 
 do_fine_tuning = False
+# With a frozen feature extractor only the Dense head learns, so run ResNet-50 once over train and
+# validation, keep the 2048-d vectors in a memory-mapped cache and train the head on those.
+USE_FEATURE_CACHE = not do_fine_tuning
+FEATURE_CACHE_DIR = './feature_cache'
+PREPROCESSING = 'resize{}x{}/255'.format(*IMAGE_SIZE)
 
 
 def build_and_compile_model():
@@ -68,6 +83,28 @@ with one_strategy.scope():
     model = build_and_compile_model()
 
 EPOCHS = 5
-hist = model.fit(train_batches,
-                 epochs=EPOCHS,
-                 validation_data=validation_batches)
+if USE_FEATURE_CACHE:
+    feature_extractor, head = model.layers
+    decoded_train_examples = train_examples.map(decode_example) if ENCODED_SHUFFLE else train_examples
+    # the cache key covers everything the features depend on: model, preprocessing, dataset name and
+    # version (info.full_name, e.g. 'cats_vs_dogs/4.0.0') and split
+    train_features, train_labels = cache_features(
+        feature_extractor, decoded_train_examples.map(format_image), FEATURE_CACHE_DIR,
+        '{}|{}|{}|{}'.format(MODULE_HANDLE, PREPROCESSING, info.full_name, splits[0]), batch_size=BATCH_SIZE)
+    validation_features, validation_labels = cache_features(
+        feature_extractor, validation_examples.map(format_image), FEATURE_CACHE_DIR,
+        '{}|{}|{}|{}'.format(MODULE_HANDLE, PREPROCESSING, info.full_name, splits[1]), batch_size=BATCH_SIZE)
+
+    # the head model shares its Dense layer with `model`, so `model` ends up trained end to end
+    with one_strategy.scope():
+        head_model = tf.keras.Sequential([tf.keras.Input(shape=train_features.shape[1:]), head])
+        head_model.compile(optimizer='adam',
+                           loss='sparse_categorical_crossentropy',
+                           metrics=['accuracy'])
+    hist = head_model.fit(feature_dataset(train_features, train_labels, BATCH_SIZE, shuffle=True),
+                          epochs=EPOCHS,
+                          validation_data=feature_dataset(validation_features, validation_labels, BATCH_SIZE))
+else:
+    hist = model.fit(train_batches,
+                     epochs=EPOCHS,
+                     validation_data=validation_batches)
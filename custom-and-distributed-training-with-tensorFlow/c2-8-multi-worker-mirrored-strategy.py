@@ -0,0 +1,123 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import tensorflow as tf
+import tensorflow_datasets as tfds
+
+from utility import free_ports
+
+tfds.disable_progress_bar()
+
+# Local CPU scale-out: instead of one process with many intra-op threads, spawn N worker processes on this
+# machine, give each its own TF_CONFIG and its own set of cores, and train the c2-5 model under
+# MultiWorkerMirroredStrategy. Running this script launches 1, 2, 4, ... workers and reports how the
+# throughput scales; the workers are this same script started with TF_CONFIG set.
+
+MAX_WORKERS = 4
+BATCH_SIZE_PER_REPLICA = 64
+BUFFER_SIZE = 10000
+WARMUP_STEPS = 20
+BENCHMARK_STEPS = 200
+DATA_DIR = './data'
+
+
+def scale(image, label):
+    image = tf.cast(image, tf.float32)
+    image /= 255
+    return image, label
+
+
+def build_and_compile_model():
+    model = tf.keras.Sequential([
+        tf.keras.layers.Conv2D(32, 3, activation='relu', input_shape=(28, 28, 1)),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(64, activation='relu'),
+        tf.keras.layers.Dense(10)
+    ])
+    model.compile(loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                  optimizer=tf.keras.optimizers.Adam(),
+                  metrics=['accuracy'])
+    return model
+
+
+def run_worker():
+    # thread pools must be sized before TF initializes the runtime
+    num_cores = int(os.environ['WORKER_NUM_CORES'])
+    tf.config.threading.set_intra_op_parallelism_threads(num_cores)
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    task = json.loads(os.environ['TF_CONFIG'])['task']
+    global_batch_size = BATCH_SIZE_PER_REPLICA * strategy.num_replicas_in_sync
+
+    mnist_train = tfds.load(name='mnist', split='train', as_supervised=True, data_dir=DATA_DIR)
+    # mnist is a single file, so shard by element: every worker keeps 1/N of the batches
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+    train_dataset = mnist_train.map(scale).cache().shuffle(BUFFER_SIZE).repeat().batch(global_batch_size)
+    train_dataset = train_dataset.with_options(options)
+
+    with strategy.scope():
+        model = build_and_compile_model()
+
+    model.fit(train_dataset, epochs=1, steps_per_epoch=WARMUP_STEPS, verbose=0)
+    start = time.perf_counter()
+    model.fit(train_dataset, epochs=1, steps_per_epoch=BENCHMARK_STEPS, verbose=0)
+    elapsed = time.perf_counter() - start
+
+    if task['index'] == 0:
+        with open(os.environ['RESULT_FILE'], 'w') as f:
+            json.dump({'workers': strategy.num_replicas_in_sync,
+                       'examples_per_sec': BENCHMARK_STEPS * global_batch_size / elapsed}, f)
+
+
+def split_cores(num_workers):
+    cores = sorted(os.sched_getaffinity(0))
+    per_worker = max(len(cores) // num_workers, 1)
+    return [cores[i * per_worker:(i + 1) * per_worker] or cores for i in range(num_workers)]
+
+
+def launch(num_workers):
+    workers = ['localhost:{}'.format(port) for port in free_ports(num_workers)]
+    core_sets = split_cores(num_workers)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_file = os.path.join(tmp_dir, 'result.json')
+        processes = []
+        for index, cores in enumerate(core_sets):
+            env = dict(os.environ,
+                       TF_CONFIG=json.dumps({'cluster': {'worker': workers},
+                                             'task': {'type': 'worker', 'index': index}}),
+                       WORKER_NUM_CORES=str(len(cores)),
+                       RESULT_FILE=result_file,
+                       CUDA_VISIBLE_DEVICES='')
+            processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env,
+                                              preexec_fn=lambda cores=cores: os.sched_setaffinity(0, cores)))
+        return_codes = [process.wait() for process in processes]
+        if any(return_codes):
+            raise RuntimeError('workers exited with {}'.format(return_codes))
+        with open(result_file) as f:
+            return json.load(f)
+
+
+if 'TF_CONFIG' in os.environ:
+    run_worker()
+    sys.exit(0)
+
+# download once up front, so the workers don't race each other preparing the dataset
+tfds.builder('mnist', data_dir=DATA_DIR).download_and_prepare()
+
+max_workers = min(MAX_WORKERS, len(os.sched_getaffinity(0)))
+worker_counts = [n for n in (1, 2, 4, 8, 16, 32) if n <= max_workers]
+results = [launch(num_workers) for num_workers in worker_counts]
+
+baseline = results[0]['examples_per_sec']
+print('{:>8} {:>16} {:>10} {:>11}'.format('workers', 'examples/sec', 'speedup', 'efficiency'))
+for result in results:
+    speedup = result['examples_per_sec'] / baseline
+    print('{:>8} {:>16.1f} {:>9.2f}x {:>10.0%}'.format(result['workers'], result['examples_per_sec'],
+                                                       speedup, speedup / result['workers']))
@@ -0,0 +1,123 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# Benchmark the cross-device ops of MirroredStrategy on logical CPU devices, instead of picking
+# HierarchicalCopyAllReduce in c2-6 on folklore. For every cross-device op, number of replicas,
+# model width and per-replica batch size, it measures the c2-6 train step time, the time of the
+# gradient all-reduce on its own, and the scaling efficiency against a single replica.
+
+NUM_VIRTUAL_CPUS = 4
+REPLICA_COUNTS = [1, 2, 4]
+WIDTH_MULTIPLIERS = [1, 4]
+BATCH_SIZES_PER_REPLICA = [32, 128]
+WARMUP_STEPS = 3
+BENCHMARK_STEPS = 20
+
+# logical devices have to be configured before the runtime is initialized
+cpu = tf.config.list_physical_devices('CPU')[0]
+tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * NUM_VIRTUAL_CPUS)
+CPU_DEVICES = ['/cpu:{}'.format(i) for i in range(NUM_VIRTUAL_CPUS)]
+
+cross_device_ops = {
+    'ReductionToOneDevice': tf.distribute.ReductionToOneDevice,
+    'HierarchicalCopyAllReduce': tf.distribute.HierarchicalCopyAllReduce,
+}
+if tf.config.list_physical_devices('GPU'):
+    cross_device_ops['NcclAllReduce'] = tf.distribute.NcclAllReduce
+
+
+# same architecture as c2-6, `width` scales the number of filters and units
+def create_model(width):
+    model = tf.keras.Sequential([
+        tf.keras.layers.Conv2D(32 * width, 3, activation='relu'),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Conv2D(64 * width, 3, activation='relu'),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(64 * width, activation='relu'),
+        tf.keras.layers.Dense(10)
+    ])
+    model.build((None, 28, 28, 1))
+    return model
+
+
+def time_steps(step, *args):
+    for _ in range(WARMUP_STEPS):
+        step(*args)
+    start = time.perf_counter()
+    for _ in range(BENCHMARK_STEPS):
+        result = step(*args)
+    # the steps run asynchronously, wait for the last one before stopping the clock
+    result.numpy()
+    return (time.perf_counter() - start) / BENCHMARK_STEPS
+
+
+def benchmark(ops_name, num_replicas, width, batch_size_per_replica):
+    strategy = tf.distribute.MirroredStrategy(devices=CPU_DEVICES[:num_replicas],
+                                              cross_device_ops=cross_device_ops[ops_name]())
+    global_batch_size = batch_size_per_replica * num_replicas
+    with strategy.scope():
+        model = create_model(width)
+        optimizer = tf.keras.optimizers.Adam()
+        loss_object = tf.keras.losses.SparseCategoricalCrossentropy(
+            from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+
+    images = np.random.rand(global_batch_size, 28, 28, 1).astype(np.float32)
+    labels = np.random.randint(0, 10, size=global_batch_size)
+    dataset = tf.data.Dataset.from_tensors((images, labels)).repeat()
+    batch = next(iter(strategy.experimental_distribute_dataset(dataset)))
+
+    def train_step(inputs):
+        images, labels = inputs
+        with tf.GradientTape() as tape:
+            predictions = model(images, training=True)
+            loss = tf.nn.compute_average_loss(loss_object(labels, predictions), global_batch_size=global_batch_size)
+        gradients = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        return loss
+
+    def all_reduce_step():
+        # all-reduce gradient-sized tensors only, without the forward and backward pass
+        gradients = [tf.ones_like(variable) for variable in model.trainable_variables]
+        reduced = tf.distribute.get_replica_context().all_reduce(tf.distribute.ReduceOp.SUM, gradients)
+        # depend on every reduced tensor so none of the all-reduces gets pruned
+        return tf.add_n([tf.reduce_sum(gradient) for gradient in reduced])
+
+    @tf.function
+    def distributed_train_step(dataset_inputs):
+        per_replica_losses = strategy.run(train_step, args=(dataset_inputs,))
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_losses, axis=None)
+
+    @tf.function
+    def distributed_all_reduce_step():
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, strategy.run(all_reduce_step), axis=None)
+
+    num_parameters = sum(int(np.prod(variable.shape)) for variable in model.trainable_variables)
+    return {'step_time': time_steps(distributed_train_step, batch),
+            'all_reduce_time': time_steps(distributed_all_reduce_step),
+            'num_parameters': num_parameters}
+
+
+print('{:<26} {:>8} {:>6} {:>6} {:>11} {:>11} {:>13} {:>11}'.format(
+    'cross device ops', 'replicas', 'width', 'batch', 'params', 'step ms', 'all-reduce ms', 'efficiency'))
+for ops_name in cross_device_ops:
+    for width in WIDTH_MULTIPLIERS:
+        for batch_size_per_replica in BATCH_SIZES_PER_REPLICA:
+            single_replica_throughput = None
+            for num_replicas in REPLICA_COUNTS:
+                try:
+                    result = benchmark(ops_name, num_replicas, width, batch_size_per_replica)
+                except (tf.errors.OpError, ValueError, NotImplementedError) as e:
+                    print('{:<26} {:>8} {:>6} {:>6} unsupported: {}'.format(
+                        ops_name, num_replicas, width, batch_size_per_replica, type(e).__name__))
+                    continue
+                throughput = batch_size_per_replica * num_replicas / result['step_time']
+                if num_replicas == 1:
+                    single_replica_throughput = throughput
+                efficiency = (throughput / (num_replicas * single_replica_throughput)
+                              if single_replica_throughput else float('nan'))
+                print('{:<26} {:>8} {:>6} {:>6} {:>11} {:>11.2f} {:>13.2f} {:>10.0%}'.format(
+                    ops_name, num_replicas, width, batch_size_per_replica, result['num_parameters'],
+                    result['step_time'] * 1000, result['all_reduce_time'] * 1000, efficiency))
@@ -0,0 +1,807 @@
+import hashlib
+import json
+import math
+import os
+import socket
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+
+
+class PersistentCompilationCache():
+    # Opt-in on-disk cache of compiled XLA executables, through TF's device compiler disk cache.
+    # Entries are keyed by the HLO fingerprint of the function (which covers the function and its input
+    # signature) and the device type; the directory is further split by TF version so an upgrade starts
+    # from an empty cache. Must be created before the TF runtime starts (any tf.config, device or strategy
+    # call), TF reads TF_XLA_FLAGS only once.
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.join(cache_dir, tf.__version__)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        flags = os.environ.get('TF_XLA_FLAGS', '')
+        os.environ['TF_XLA_FLAGS'] = '{} --tf_xla_persistent_cache_directory={}'.format(flags, self.cache_dir).strip()
+        self.hits = 0
+        self.misses = 0
+        self.inactive = 0
+        self.startup_seconds = {}
+
+    def entries(self):
+        return sum(len(files) for _, _, files in os.walk(self.cache_dir))
+
+    def record(self, name, seconds, entries_before):
+        # a traced call that wrote no new executable was served from the cache, unless the cache is still
+        # empty: then TF never picked up the flag (set after the runtime started) or nothing was jit-compiled
+        entries = self.entries()
+        if entries == 0:
+            self.inactive += 1
+            kind = 'cache not active'
+        elif entries > entries_before:
+            self.misses += 1
+            kind = 'cold'
+        else:
+            self.hits += 1
+            kind = 'warm'
+        self.startup_seconds.setdefault(name, (kind, seconds))
+
+    def report(self):
+        history_file = os.path.join(os.path.dirname(self.cache_dir), 'startup_times.json')
+        history = []
+        if os.path.exists(history_file):
+            with open(history_file) as f:
+                history = json.load(f)
+        print('Compilation cache {}: {} hits, {} misses, {} entries'.format(
+            self.cache_dir, self.hits, self.misses, self.entries()))
+        if self.inactive:
+            print('  cache not active: {} traced calls wrote no executable to an empty cache directory'.format(
+                self.inactive))
+        for name, (kind, seconds) in self.startup_seconds.items():
+            previous = [run[name] for run in history if name in run]
+            print('  {}: first call {:.2f}s ({}){}'.format(
+                name, seconds, kind, ', previous run {:.2f}s ({})'.format(*previous[-1]) if previous else ''))
+        history.append({name: [seconds, kind] for name, (kind, seconds) in self.startup_seconds.items()})
+        with open(history_file, 'w') as f:
+            json.dump(history, f)
+
+
+class RetracingError(RuntimeError):
+    pass
+
+
+def _describe_arguments(args, kwargs):
+    def describe(value):
+        if tf.is_tensor(value):
+            return '{}{}'.format(value.dtype.name, value.shape)
+        return repr(value)
+
+    return tf.nest.map_structure(describe, (args, kwargs), expand_composites=False)
+
+
+class TracedFunction():
+    # tf.function that counts its traces and logs the signature that caused each one.
+    # Past `max_traces` it warns, or raises RetracingError with on_excess='raise'.
+    # With `bucket_sizes`, tensor arguments are zero padded along the batch axis to the next bucket
+    # before the call and sliced back to the true size inside the graph, so a ragged final batch
+    # reuses the graph of its bucket instead of tracing a new one. The results are unchanged.
+    # With a `compilation_cache`, the wall time of each tracing call is recorded as cold or warm startup.
+    def __init__(self, python_function, max_traces=5, on_excess='warn', bucket_sizes=None, compilation_cache=None,
+                 **tf_function_kwargs):
+        self.python_function = python_function
+        self.name = getattr(python_function, '__name__', repr(python_function))
+        self.max_traces = max_traces
+        self.on_excess = on_excess
+        self.bucket_sizes = sorted(bucket_sizes) if bucket_sizes else None
+        self.compilation_cache = compilation_cache
+        self.trace_count = 0
+        self.trace_signatures = []
+        self.function = tf.function(self._traced, **tf_function_kwargs)
+
+    def _traced(self, *args, **kwargs):
+        # the python body only runs while tf.function is tracing
+        valid_size = kwargs.pop('_valid_size', None)
+        signature = _describe_arguments(args, kwargs)
+        self.trace_count += 1
+        self.trace_signatures.append(signature)
+        print('Tracing {} (trace #{}) with {}'.format(self.name, self.trace_count, signature))
+        if self.trace_count > self.max_traces:
+            message = '{} has been traced {} times, the signatures were {}'.format(
+                self.name, self.trace_count, self.trace_signatures)
+            if self.on_excess == 'raise':
+                raise RetracingError(message)
+            warnings.warn(message)
+        if valid_size is not None:
+            args, kwargs = tf.nest.map_structure(
+                lambda value: value[:valid_size] if tf.is_tensor(value) and value.shape.rank else value,
+                (args, kwargs))
+        return self.python_function(*args, **kwargs)
+
+    def _bucket_size(self, size):
+        for bucket_size in self.bucket_sizes:
+            if size <= bucket_size:
+                return bucket_size
+        return size
+
+    def _pad_to_bucket(self, args, kwargs):
+        tensors = [value for value in tf.nest.flatten((args, kwargs)) if tf.is_tensor(value) and value.shape.rank]
+        if not tensors:
+            return args, kwargs, None
+        size = tensors[0].shape[0]
+        padding = self._bucket_size(size) - size
+
+        def pad(value):
+            if not (tf.is_tensor(value) and value.shape.rank and value.shape[0] == size):
+                return value
+            return tf.pad(value, [[0, padding]] + [[0, 0]] * (value.shape.rank - 1))
+
+        args, kwargs = tf.nest.map_structure(pad, (args, kwargs))
+        return args, kwargs, tf.constant(size, dtype=tf.int32)
+
+    def __call__(self, *args, **kwargs):
+        if self.bucket_sizes:
+            args, kwargs, valid_size = self._pad_to_bucket(args, kwargs)
+            if valid_size is not None:
+                kwargs['_valid_size'] = valid_size
+        if self.compilation_cache is None:
+            return self.function(*args, **kwargs)
+        trace_count = self.trace_count
+        entries = self.compilation_cache.entries()
+        start = time.perf_counter()
+        result = self.function(*args, **kwargs)
+        if self.trace_count > trace_count:
+            self.compilation_cache.record(self.name, time.perf_counter() - start, entries)
+        return result
+
+
+def traced_function(python_function=None, **kwargs):
+    # usable as @traced_function or @traced_function(max_traces=..., bucket_sizes=...)
+    if python_function is None:
+        return lambda function: TracedFunction(function, **kwargs)
+    return TracedFunction(python_function, **kwargs)
+
+
+def steps_per_epoch(dataset):
+    # read the step count from the dataset cardinality instead of iterating the whole dataset once
+    cardinality = int(dataset.cardinality())
+    return cardinality if cardinality >= 0 else None
+
+
+class TrainLoop():
+    # Compiled training loop for a custom GradientTape step.
+    # Each call to `run_steps` runs up to `steps_per_call` steps inside one tf.function with a fixed
+    # input signature, so it is traced once. Loss and metric stay on device and are only read back
+    # every `log_every` calls.
+    def __init__(self, model, optimizer, loss_object, metric, element_spec, steps_per_call=50, log_every=1):
+        self.model = model
+        self.optimizer = optimizer
+        self.loss_object = loss_object
+        self.metric = metric
+        self.steps_per_call = steps_per_call
+        self.log_every = log_every
+        self.loss_sum = tf.Variable(0.0, trainable=False)
+        self.step_count = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.run_steps = TracedFunction(self._run_steps, max_traces=1,
+                                        input_signature=[tf.data.IteratorSpec(element_spec),
+                                                         tf.TensorSpec([], tf.int64)])
+
+    def _train_step(self, x, y):
+        with tf.GradientTape() as tape:
+            logits = self.model(x, training=True)
+            loss_value = self.loss_object(y_true=y, y_pred=logits)
+        gradients = tape.gradient(loss_value, self.model.trainable_weights)
+        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_weights))
+        self.metric.update_state(y, logits)
+        self.loss_sum.assign_add(loss_value)
+        self.step_count.assign_add(1)
+
+    def _run_steps(self, iterator, num_steps):
+        steps_run = tf.constant(0, dtype=tf.int64)
+        for _ in tf.range(num_steps):
+            # stop cleanly at the end of the epoch, the last call may run fewer steps
+            next_batch = iterator.get_next_as_optional()
+            if not next_batch.has_value():
+                break
+            x, y = next_batch.get_value()
+            self._train_step(x, y)
+            steps_run += 1
+        return steps_run
+
+    def result(self):
+        return self.loss_sum / tf.cast(tf.maximum(self.step_count, 1), tf.float32)
+
+    def train_epoch(self, dataset):
+        self.loss_sum.assign(0.0)
+        self.step_count.assign(0)
+        pbar = tqdm(total=steps_per_epoch(dataset), position=0, leave=True,
+                    bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} ')
+        iterator = iter(dataset)
+        num_steps = tf.constant(self.steps_per_call, dtype=tf.int64)
+        calls = 0
+        while True:
+            steps_run = int(self.run_steps(iterator, num_steps))
+            calls += 1
+            pbar.update(steps_run)
+            done = steps_run < self.steps_per_call
+            if done or calls % self.log_every == 0:
+                pbar.set_description("Training loss for step %s: %.4f" % (int(self.step_count), float(self.result())))
+            if done:
+                break
+        pbar.close()
+        return float(self.result())
+
+
+def measure_steps_per_second(train_one_epoch, num_steps):
+    start = time.perf_counter()
+    train_one_epoch()
+    return num_steps / (time.perf_counter() - start)
+
+
+class BackgroundValidator():
+    # Runs validation on a snapshot of the weights in a worker thread, so the next epoch can start
+    # training while the previous one is still being evaluated. The snapshot goes into a shadow model
+    # with its own metric, the training model and metrics are never touched from the worker.
+    # tf.config.threading is process wide, so the op thread pools are shared with training; the
+    # validation input pipeline gets its own private pool of `num_threads` threads.
+    def __init__(self, model, dataset, loss_object, metric, num_threads=2, bucket_sizes=None):
+        self.shadow_model = tf.keras.models.clone_model(model)
+        options = tf.data.Options()
+        options.threading.private_threadpool_size = num_threads
+        self.dataset = dataset.with_options(options)
+        self.loss_object = loss_object
+        self.metric = metric
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.eval_step = TracedFunction(self._eval_step, max_traces=len(bucket_sizes or []) + 1,
+                                        bucket_sizes=bucket_sizes)
+
+    def _eval_step(self, x, y):
+        logits = self.shadow_model(x, training=False)
+        self.metric.update_state(y, logits)
+        return self.loss_object(y_true=y, y_pred=logits)
+
+    def _validate(self, epoch, weights):
+        self.shadow_model.set_weights(weights)
+        self.metric.reset_states()
+        losses = [self.eval_step(x, y) for x, y in self.dataset]
+        return epoch, float(np.mean(losses)), float(self.metric.result())
+
+    def submit(self, epoch, model):
+        # copy the weights on the calling thread so the snapshot belongs to the epoch that just finished
+        return self.executor.submit(self._validate, epoch, model.get_weights())
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def predict_streaming(model, dataset, num_classes, sample_size=10, seed=None):
+    # Iterates the batched dataset once and keeps only O(sample_size + batch) examples in memory.
+    # The reservoir keeps the `sample_size` examples with the smallest random keys, which is a uniform
+    # sample without replacement over the whole stream. The confusion matrix is accumulated per batch.
+    rng = np.random.default_rng(seed)
+    confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+    sample_keys = np.empty((0,))
+    samples = None
+    for x, y in dataset:
+        y_pred = model(x, training=False).numpy()
+        x, y = x.numpy(), y.numpy()
+        confusion += tf.math.confusion_matrix(y, np.argmax(y_pred, axis=-1), num_classes=num_classes,
+                                              dtype=tf.int64).numpy()
+
+        keys = np.concatenate([sample_keys, rng.random(len(y))])
+        candidates = (x, y_pred, y) if samples is None else tuple(
+            np.concatenate([kept, new]) for kept, new in zip(samples, (x, y_pred, y)))
+        keep = np.argsort(keys)[:sample_size]
+        sample_keys = keys[keep]
+        samples = tuple(candidate[keep] for candidate in candidates)
+
+    per_class_accuracy = np.diag(confusion) / np.maximum(confusion.sum(axis=1), 1)
+    return samples, confusion, per_class_accuracy
+
+
+def snapshot_cache(dataset, cache_dir, num_shards=8):
+    # On-disk replacement for `.cache()`. The first run writes the post-map dataset to `num_shards` files
+    # under `cache_dir`, later epochs and later runs read them back with a parallel interleave.
+    # tf.data names the snapshot after a fingerprint of the upstream dataset graph, so changing any
+    # upstream transform writes a fresh snapshot instead of reading a stale one. Finished snapshots are
+    # plain files, several worker processes can read them at once and share the OS page cache.
+    def read_shards(shards):
+        return shards.interleave(lambda shard: shard, cycle_length=num_shards,
+                                 num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+
+    dataset = dataset.enumerate().snapshot(cache_dir, reader_func=read_shards,
+                                           shard_func=lambda index, element: index % num_shards)
+    return dataset.map(lambda index, element: element, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def free_ports(count):
+    # ask the OS for `count` unused local ports
+    sockets = [socket.socket() for _ in range(count)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+class StepCheckpointer():
+    # Step-granular checkpointing for the custom distributed loops. Every `save_every` steps it saves
+    # the given trackables (model, optimizer, metrics, ...) together with the epoch, the step within the
+    # epoch and the position of the epoch's data iterator, asynchronously. A restarted job restores all
+    # of it and resumes at the exact step, so at most `save_every` steps of work are lost.
+    def __init__(self, directory, save_every=100, max_to_keep=3, **trackables):
+        self.save_every = save_every
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.checkpoint = tf.train.Checkpoint(epoch=self.epoch, step=self.step, **trackables)
+        self.manager = tf.train.CheckpointManager(self.checkpoint, directory, max_to_keep=max_to_keep)
+        self.options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+        self.iterator_name = None
+        self.unsaved_steps = 0
+        # objects created later (lazily built models, optimizer slots, iterators) are restored when
+        # they are first attached or created
+        self.checkpoint.restore(self.manager.latest_checkpoint)
+        if self.manager.latest_checkpoint:
+            print('Resuming from {} at epoch {} step {}'.format(
+                self.manager.latest_checkpoint, int(self.epoch), int(self.step)))
+
+    def begin_epoch(self, epoch, iterator):
+        # returns the number of steps of this epoch that are already done
+        if epoch != int(self.epoch):
+            self.epoch.assign(epoch)
+            self.step.assign(0)
+        # one attribute name per epoch, so the saved position of an old epoch's iterator is never
+        # restored into the iterator of a new epoch
+        if self.iterator_name is not None:
+            delattr(self.checkpoint, self.iterator_name)
+        self.iterator_name = 'train_iterator_{}'.format(epoch)
+        setattr(self.checkpoint, self.iterator_name, iterator)
+        self.unsaved_steps = 0
+        return int(self.step)
+
+    def end_steps(self, num_steps=1):
+        self.step.assign_add(num_steps)
+        self.unsaved_steps += num_steps
+        if self.unsaved_steps >= self.save_every:
+            self.manager.save(options=self.options)
+            self.unsaved_steps = 0
+
+    def end_epoch(self):
+        self.epoch.assign_add(1)
+        self.step.assign(0)
+
+    def wait(self):
+        # block until the pending asynchronous save has been written
+        self.checkpoint.sync()
+
+
+# Flowers TFRecord input pipeline of c2-6-tpu-strategy.py
+FLOWERS_CLASSES = ['daisy', 'dandelion', 'roses', 'sunflowers', 'tulips']
+
+
+def read_tfrecord(example):
+    features = {
+        "image": tf.io.FixedLenFeature([], tf.string),  # tf.string means bytestring
+        "class": tf.io.FixedLenFeature([], tf.int64),  # shape [] means scalar
+        "one_hot_class": tf.io.VarLenFeature(tf.float32),
+    }
+    example = tf.io.parse_single_example(example, features)
+    image = example['image']
+    class_label = example['class']
+    image = tf.image.decode_jpeg(image, channels=3)
+    image = tf.image.resize(image, [224, 224])
+    image = tf.cast(image, tf.float32) / 255.0  # convert image to floats in [0, 1] range
+    class_label = tf.cast(class_label, tf.int32)
+    return image, class_label
+
+
+def read_tfrecord_batch(examples):
+    # Same output as `read_tfrecord`, for a whole batch of serialized records at once:
+    # one parse_example op per batch, the JPEG decodes run in parallel across the batch and the
+    # cast and scaling are a single vectorized op.
+    features = {
+        "image": tf.io.FixedLenFeature([], tf.string),
+        "class": tf.io.FixedLenFeature([], tf.int64),
+    }
+    example = tf.io.parse_example(examples, features)
+    images = tf.map_fn(lambda image: tf.image.resize(tf.image.decode_jpeg(image, channels=3), [224, 224]),
+                       example['image'], fn_output_signature=tf.TensorSpec([224, 224, 3], tf.float32),
+                       parallel_iterations=32)
+    images = images / 255.0  # convert image to floats in [0, 1] range
+    class_labels = tf.cast(example['class'], tf.int32)
+    return images, class_labels
+
+
+def load_tfrecords(filenames):
+    # read from TFRecords. For optimal performance, use "interleave(tf.data.TFRecordDataset, ...)"
+    # to read from multiple TFRecord files at once and set the option experimental_deterministic = False
+    # to allow order-altering optimizations.
+    option_no_order = tf.data.Options()
+    option_no_order.experimental_deterministic = False
+
+    dataset = tf.data.Dataset.from_tensor_slices(filenames)
+    dataset = dataset.with_options(option_no_order)
+    dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=16,
+                                 num_parallel_calls=tf.data.AUTOTUNE)  # faster
+    return dataset
+
+
+def load_dataset(filenames):
+    return load_tfrecords(filenames).map(read_tfrecord, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def get_batched_dataset(filenames, batch_size, batch_parse=False):
+    if batch_parse:
+        # shuffle and batch the serialized records, then parse and decode once per batch;
+        # the shuffle buffer holds compressed bytes instead of decoded float images
+        dataset = load_tfrecords(filenames)
+        dataset = dataset.shuffle(2048)
+        dataset = dataset.batch(batch_size, drop_remainder=False)
+        dataset = dataset.map(read_tfrecord_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    else:
+        dataset = load_dataset(filenames)
+        dataset = dataset.shuffle(2048)
+        dataset = dataset.batch(batch_size, drop_remainder=False)  # drop_remainder will be needed on TPU
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)  # prefetch next batch while training
+    return dataset
+
+
+def write_flowers_tfrecords(output_dir, num_shards=16, examples_per_shard=230, image_size=(224, 224), seed=0):
+    # Writes local TFRecord shards with the same schema as gs://flowers-public, filled with random
+    # JPEGs, so the input pipeline can be benchmarked offline.
+    tf.io.gfile.makedirs(output_dir)
+    rng = np.random.default_rng(seed)
+    filenames = []
+    for shard in range(num_shards):
+        filename = os.path.join(output_dir, 'flowers{:02d}-{}.tfrec'.format(shard, examples_per_shard))
+        with tf.io.TFRecordWriter(filename) as writer:
+            for _ in range(examples_per_shard):
+                pixels = rng.integers(0, 256, size=tuple(image_size) + (3,), dtype=np.uint8)
+                label = int(rng.integers(len(FLOWERS_CLASSES)))
+                one_hot_class = np.eye(len(FLOWERS_CLASSES), dtype=np.float32)[label]
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[tf.io.encode_jpeg(pixels).numpy()])),
+                    'class': tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+                    'one_hot_class': tf.train.Feature(float_list=tf.train.FloatList(value=one_hot_class)),
+                }))
+                writer.write(example.SerializeToString())
+        filenames.append(filename)
+    return filenames
+
+
+def read_uint8_tfrecord_batch(examples):
+    # Records written by `convert_to_uint8_tfrecords`: the image is already decoded and resized,
+    # all that's left is a reshape and the cast to float.
+    features = {
+        "image_raw": tf.io.FixedLenFeature([], tf.string),
+        "class": tf.io.FixedLenFeature([], tf.int64),
+    }
+    example = tf.io.parse_example(examples, features)
+    images = tf.reshape(tf.io.decode_raw(example['image_raw'], tf.uint8), [-1, 224, 224, 3])
+    images = tf.cast(images, tf.float32) / 255.0  # convert image to floats in [0, 1] range
+    class_labels = tf.cast(example['class'], tf.int32)
+    return images, class_labels
+
+
+def get_batched_uint8_dataset(filenames, batch_size):
+    dataset = load_tfrecords(filenames)
+    dataset = dataset.shuffle(2048)
+    dataset = dataset.batch(batch_size, drop_remainder=False)
+    dataset = dataset.map(read_uint8_tfrecord_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    return dataset
+
+
+def convert_to_uint8_tfrecords(filenames, output_dir):
+    # Converter from the JPEG records to fixed-size uint8 records: every image is decoded and resized
+    # to 224x224 once and stored as 224*224*3 raw bytes next to its label. Each input shard becomes an
+    # output shard with the same name, so an existing train/validation split by file carries over.
+    # Shards are written under a temporary name and renamed when complete, and a marker file is written
+    # after the last one. A finished cache is reused as is; an interrupted one is converted again.
+    output_filenames = [os.path.join(output_dir, os.path.basename(filename)) for filename in filenames]
+    marker = os.path.join(output_dir, '_COMPLETE')
+    if tf.io.gfile.exists(marker):
+        return output_filenames
+    tf.io.gfile.makedirs(output_dir)
+    for filename, output_filename in zip(filenames, output_filenames):
+        dataset = tf.data.TFRecordDataset(filename).map(read_tfrecord, num_parallel_calls=tf.data.AUTOTUNE)
+        with tf.io.TFRecordWriter(output_filename + '.tmp') as writer:
+            for image, class_label in dataset:
+                pixels = tf.cast(tf.round(tf.clip_by_value(image * 255.0, 0.0, 255.0)), tf.uint8)
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    'image_raw': tf.train.Feature(bytes_list=tf.train.BytesList(value=[pixels.numpy().tobytes()])),
+                    'class': tf.train.Feature(int64_list=tf.train.Int64List(value=[int(class_label)])),
+                }))
+                writer.write(example.SerializeToString())
+        tf.io.gfile.rename(output_filename + '.tmp', output_filename, overwrite=True)
+    with tf.io.gfile.GFile(marker, 'w') as f:
+        f.write('{} shards\n'.format(len(output_filenames)))
+    return output_filenames
+
+
+def measure_images_per_second(dataset, num_batches, warmup_batches=5):
+    # returns images/sec and the host CPU seconds spent per batch (all threads of this process)
+    iterator = iter(dataset)
+    for _ in range(warmup_batches):
+        next(iterator)
+    num_images = 0
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    for _ in range(num_batches):
+        images, _ = next(iterator)
+        num_images += int(tf.shape(images)[0])
+    cpu_seconds = time.process_time() - cpu_start
+    return num_images / (time.perf_counter() - start), cpu_seconds / num_batches
+
+
+class DataEcho():
+    # Data echoing for input-bound training: every prepared batch is repeated `echo_factor` times right
+    # after the expensive decode, optionally re-augmented per copy, so the accelerator isn't left waiting
+    # on the input pipeline. The factor lives in a CPU variable that the pipeline reads for every batch;
+    # `update` adapts it to the measured fraction of step time spent waiting for input.
+    # `device` is the CPU the input pipeline runs on, for a remote TPU host that is the worker's CPU.
+    def __init__(self, echo_factor=1, max_echo_factor=4, augment_fn=None, target_wait_fraction=0.1,
+                 device='/cpu:0'):
+        with tf.device(device):
+            self.echo_factor = tf.Variable(echo_factor, dtype=tf.int64, trainable=False)
+        self.max_echo_factor = max_echo_factor
+        self.augment_fn = augment_fn
+        self.target_wait_fraction = target_wait_fraction
+
+    def __call__(self, dataset):
+        dataset = dataset.flat_map(
+            lambda images, labels: tf.data.Dataset.from_tensors((images, labels)).repeat(self.echo_factor))
+        if self.augment_fn is not None:
+            dataset = dataset.map(self.augment_fn, num_parallel_calls=tf.data.AUTOTUNE)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    def update(self, input_wait_seconds, total_seconds):
+        wait_fraction = input_wait_seconds / max(total_seconds, 1e-9)
+        echo_factor = int(self.echo_factor)
+        if wait_fraction > self.target_wait_fraction and echo_factor < self.max_echo_factor:
+            echo_factor += 1
+        elif wait_fraction < self.target_wait_fraction / 4 and echo_factor > 1:
+            echo_factor -= 1
+        self.echo_factor.assign(echo_factor)
+        return wait_fraction, echo_factor
+
+
+class WarmupLinearScaling(tf.keras.optimizers.schedules.LearningRateSchedule):
+    # Learning rate for large-batch training: `base_learning_rate` is tuned at `base_batch_size` and
+    # scaled linearly to `global_batch_size`. It ramps up linearly over `warmup_steps`, then follows a
+    # cosine decay to zero at `total_steps`.
+    def __init__(self, base_learning_rate, base_batch_size, global_batch_size, warmup_steps, total_steps):
+        super().__init__()
+        self.base_learning_rate = base_learning_rate
+        self.base_batch_size = base_batch_size
+        self.global_batch_size = global_batch_size
+        self.warmup_steps = warmup_steps
+        self.total_steps = total_steps
+
+    def __call__(self, step):
+        step = tf.cast(step, tf.float32)
+        peak_learning_rate = self.base_learning_rate * self.global_batch_size / self.base_batch_size
+        warmup = peak_learning_rate * step / max(self.warmup_steps, 1)
+        progress = tf.clip_by_value((step - self.warmup_steps) / max(self.total_steps - self.warmup_steps, 1), 0.0, 1.0)
+        decay = peak_learning_rate * 0.5 * (1.0 + tf.cos(math.pi * progress))
+        return tf.where(step < self.warmup_steps, warmup, decay)
+
+    def get_config(self):
+        return {'base_learning_rate': self.base_learning_rate, 'base_batch_size': self.base_batch_size,
+                'global_batch_size': self.global_batch_size, 'warmup_steps': self.warmup_steps,
+                'total_steps': self.total_steps}
+
+
+def _layer_adaptation(variable, exclude_from_layer_adaptation):
+    return not any(name in variable.name for name in exclude_from_layer_adaptation)
+
+
+def _trust_ratio(weight_norm, update_norm):
+    return tf.where(tf.logical_and(weight_norm > 0, update_norm > 0), weight_norm / update_norm, 1.0)
+
+
+class LAMB(tf.keras.optimizers.Optimizer):
+    # Layer-wise adaptive Adam (You et al., 2019): the Adam update plus decoupled weight decay, rescaled
+    # per variable by the trust ratio ||w|| / ||update||. Biases and normalization parameters are left
+    # out of the decay and the trust ratio.
+    def __init__(self, learning_rate=0.001, beta_1=0.9, beta_2=0.999, epsilon=1e-6, weight_decay_rate=0.01,
+                 exclude_from_layer_adaptation=('bias', 'batch_normalization'), name='LAMB', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self._learning_rate = self._build_learning_rate(learning_rate)
+        self.beta_1 = beta_1
+        self.beta_2 = beta_2
+        self.epsilon = epsilon
+        self.weight_decay_rate = weight_decay_rate
+        self.exclude_from_layer_adaptation = exclude_from_layer_adaptation
+
+    def build(self, var_list):
+        super().build(var_list)
+        if hasattr(self, '_built') and self._built:
+            return
+        self._built = True
+        self._momentums = [self.add_variable_from_reference(model_variable=var, variable_name='m') for var in var_list]
+        self._velocities = [self.add_variable_from_reference(model_variable=var, variable_name='v') for var in var_list]
+
+    def update_step(self, gradient, variable):
+        gradient = tf.convert_to_tensor(gradient)
+        lr = tf.cast(self.learning_rate, variable.dtype)
+        local_step = tf.cast(self.iterations + 1, variable.dtype)
+        beta_1 = tf.cast(self.beta_1, variable.dtype)
+        beta_2 = tf.cast(self.beta_2, variable.dtype)
+        index = self._index_dict[self._var_key(variable)]
+        m = self._momentums[index]
+        v = self._velocities[index]
+
+        m.assign(beta_1 * m + (1 - beta_1) * gradient)
+        v.assign(beta_2 * v + (1 - beta_2) * tf.square(gradient))
+        m_hat = m / (1 - tf.pow(beta_1, local_step))
+        v_hat = v / (1 - tf.pow(beta_2, local_step))
+        update = m_hat / (tf.sqrt(v_hat) + self.epsilon)
+
+        if _layer_adaptation(variable, self.exclude_from_layer_adaptation):
+            update += self.weight_decay_rate * variable
+            update *= _trust_ratio(tf.norm(variable), tf.norm(update))
+        variable.assign_sub(lr * update)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'learning_rate': self._serialize_hyperparameter(self._learning_rate),
+            'beta_1': self.beta_1,
+            'beta_2': self.beta_2,
+            'epsilon': self.epsilon,
+            'weight_decay_rate': self.weight_decay_rate,
+            'exclude_from_layer_adaptation': self.exclude_from_layer_adaptation,
+        })
+        return config
+
+
+class LARS(tf.keras.optimizers.Optimizer):
+    # Layer-wise adaptive rate scaling (You et al., 2017): momentum SGD where each variable's learning
+    # rate is scaled by eta * ||w|| / (||g|| + weight_decay * ||w||). Biases and normalization
+    # parameters use plain momentum SGD.
+    def __init__(self, learning_rate=0.1, momentum=0.9, eta=0.001, weight_decay_rate=1e-4,
+                 exclude_from_layer_adaptation=('bias', 'batch_normalization'), name='LARS', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self._learning_rate = self._build_learning_rate(learning_rate)
+        self.momentum = momentum
+        self.eta = eta
+        self.weight_decay_rate = weight_decay_rate
+        self.exclude_from_layer_adaptation = exclude_from_layer_adaptation
+
+    def build(self, var_list):
+        super().build(var_list)
+        if hasattr(self, '_built') and self._built:
+            return
+        self._built = True
+        self._momentums = [self.add_variable_from_reference(model_variable=var, variable_name='m') for var in var_list]
+
+    def update_step(self, gradient, variable):
+        gradient = tf.convert_to_tensor(gradient)
+        lr = tf.cast(self.learning_rate, variable.dtype)
+        m = self._momentums[self._index_dict[self._var_key(variable)]]
+
+        if _layer_adaptation(variable, self.exclude_from_layer_adaptation):
+            weight_norm = tf.norm(variable)
+            gradient_norm = tf.norm(gradient)
+            local_lr = self.eta * _trust_ratio(weight_norm, gradient_norm + self.weight_decay_rate * weight_norm)
+            gradient = local_lr * (gradient + self.weight_decay_rate * variable)
+        m.assign(self.momentum * m + lr * gradient)
+        variable.assign_sub(m)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'learning_rate': self._serialize_hyperparameter(self._learning_rate),
+            'momentum': self.momentum,
+            'eta': self.eta,
+            'weight_decay_rate': self.weight_decay_rate,
+            'exclude_from_layer_adaptation': self.exclude_from_layer_adaptation,
+        })
+        return config
+
+
+def cache_features(feature_extractor, dataset, cache_dir, key, batch_size=32):
+    # Runs a frozen feature extractor once over `dataset` of (image, label) pairs and stores the feature
+    # vectors in a .npy file that is opened memory-mapped, so the head trains from disk without holding
+    # the features in memory. `key` names the model handle, preprocessing, dataset name and version
+    # and split; a split string alone such as 'train[:80%]' is the same for every dataset. Change any
+    # of them and a new cache entry is written. Returns (features, labels).
+    os.makedirs(cache_dir, exist_ok=True)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    features_path = os.path.join(cache_dir, digest + '-features.npy')
+    labels_path = os.path.join(cache_dir, digest + '-labels.npy')
+
+    if not (os.path.exists(features_path) and os.path.exists(labels_path)):
+        num_examples = int(dataset.cardinality())
+        if num_examples < 0:
+            raise ValueError('cache_features needs a dataset of known, finite cardinality')
+        extract = tf.function(lambda images: feature_extractor(images, training=False))
+        labels = None
+        features = None
+        tmp_path = features_path + '.tmp'
+        offset = 0
+        print('Caching features for {} in {}'.format(key, features_path))
+        for images, batch_labels in tqdm(dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE),
+                                         total=math.ceil(num_examples / batch_size)):
+            batch_features = extract(images).numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                                     shape=(num_examples,) + batch_features.shape[1:])
+                labels = np.empty(num_examples, dtype=batch_labels.dtype.as_numpy_dtype)
+            features[offset:offset + len(batch_features)] = batch_features
+            labels[offset:offset + len(batch_features)] = batch_labels.numpy()
+            offset += len(batch_features)
+        features.flush()
+        del features
+        np.save(labels_path, labels)
+        # the features file appears last and complete, an interrupted run leaves only the .tmp behind
+        os.replace(tmp_path, features_path)
+
+    return np.load(features_path, mmap_mode='r'), np.load(labels_path)
+
+
+def feature_dataset(features, labels, batch_size, shuffle=False):
+    # Batches of cached features, gathered from the memory map by index so only one batch is in memory.
+    def gather(indices):
+        # sorted reads walk the file forward
+        indices = np.sort(indices)
+        return np.asarray(features[indices]), labels[indices]
+
+    def load(indices):
+        batch_features, batch_labels = tf.numpy_function(
+            gather, [indices], [tf.float32, tf.as_dtype(labels.dtype)])
+        batch_features.set_shape((None,) + features.shape[1:])
+        batch_labels.set_shape((None,))
+        return batch_features, batch_labels
+
+    dataset = tf.data.Dataset.range(len(features))
+    if shuffle:
+        dataset = dataset.shuffle(len(features))
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def decode_example(image, label):
+    # decodes an image that tfds left encoded, loaded with decoders={'image': tfds.decode.SkipDecoding()}
+    return tf.io.decode_image(image, channels=3, expand_animations=False), label
+
+
+def _element_bytes(element):
+    total = 0
+    for tensor in tf.nest.flatten(element):
+        if tensor.dtype == tf.string:
+            total += int(tf.reduce_sum(tf.strings.length(tensor)))
+        else:
+            total += int(tf.size(tensor)) * tensor.dtype.size
+    return total
+
+
+def shuffle_buffer_bytes(examples, buffer_size, num_samples=100):
+    # estimated memory of a full shuffle buffer over `examples`, from the mean size of a sample
+    sizes = [_element_bytes(element) for element in examples.take(num_samples)]
+    return buffer_size * sum(sizes) / max(len(sizes), 1)
+
+
+def time_to_first_batch(dataset):
+    # includes filling the shuffle buffer, which blocks the first training step
+    start = time.perf_counter()
+    next(iter(dataset))
+    return time.perf_counter() - start
+
+
+def make_train_batches(examples, format_image, batch_size, buffer_size, encoded=False, benchmark=False):
+    # Shuffled training batches. With `encoded`, the images of `examples` are still the JPEG/PNG bytes:
+    # the shuffle buffer keeps its length, so the order is as random, but holds a few KB per element
+    # instead of a decoded image, and decoding happens after the shuffle. With `benchmark` it prints the
+    # buffer memory and the time to the first batch, which fills the shuffle buffer once more.
+    dataset = examples.shuffle(buffer_size)
+    if encoded:
+        dataset = dataset.map(decode_example, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.map(format_image, num_parallel_calls=tf.data.AUTOTUNE).batch(batch_size).prefetch(1)
+    if benchmark:
+        print('Shuffle buffer: {:.1f} MB of {} images'.format(shuffle_buffer_bytes(examples, buffer_size) / 2 ** 20,
+                                                            'encoded' if encoded else 'decoded'))
+        print('Time to first batch: {:.2f}s'.format(time_to_first_batch(dataset)))
+    return dataset
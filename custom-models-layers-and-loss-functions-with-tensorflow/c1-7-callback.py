@@ -18,12 +18,21 @@ import math
 import datetime
 import pandas as pd
 
+from utility import make_train_batches
+
+# shuffle the encoded training images and the file shards, decode after the shuffle
+ENCODED_SHUFFLE = True
+# print the shuffle buffer memory and the time to the first batch (fills the buffer one extra time)
+BENCHMARK_SHUFFLE = False
+
 # horses_or_humans 3.0.0 has already been downloaded for you
 path = "./dataset"
-splits, info = tfds.load('horses_or_humans', data_dir=path, as_supervised=True, with_info=True,
-                         split=['train[:80%]', 'train[80%:]', 'test'])
-
-(train_examples, validation_examples, test_examples) = splits
+split_names = ['train[:80%]', 'train[80%:]', 'test']
+(validation_examples, test_examples), info = tfds.load('horses_or_humans', data_dir=path, as_supervised=True,
+                                                       with_info=True, split=split_names[1:])
+train_examples = tfds.load('horses_or_humans', data_dir=path, as_supervised=True, split=split_names[0],
+                           shuffle_files=ENCODED_SHUFFLE,
+                           decoders={'image': tfds.decode.SkipDecoding()} if ENCODED_SHUFFLE else None)
 
 num_examples = info.splits['train'].num_examples
 num_classes = info.features['label'].num_classes
@@ -39,7 +48,8 @@ def format_image(image, label):
 
 BATCH_SIZE = 32  # @param {type:"integer"}
 
-train_batches = train_examples.shuffle(num_examples // 4).map(format_image).batch(BATCH_SIZE).prefetch(1)
+train_batches = make_train_batches(train_examples, format_image, BATCH_SIZE, num_examples // 4,
+                                   encoded=ENCODED_SHUFFLE, benchmark=BENCHMARK_SHUFFLE)
 validation_batches = validation_examples.map(format_image).batch(BATCH_SIZE).prefetch(1)
 test_batches = test_examples.map(format_image).batch(1)
 
@@ -1,4 +1,7 @@
+import time
+
 import numpy as np
+import tensorflow as tf
 from keras import backend as K
 from matplotlib import pyplot as plt
 
@@ -86,3 +89,47 @@ def display_images(left, right, predictions, labels, title, n):
     right = np.swapaxes(right, 0, 1)
     right = np.reshape(right, [28, 28*n])
     plt.imshow(right)
+
+
+def decode_example(image, label):
+    # decodes an image that tfds left encoded, loaded with decoders={'image': tfds.decode.SkipDecoding()}
+    return tf.io.decode_image(image, channels=3, expand_animations=False), label
+
+
+def _element_bytes(element):
+    total = 0
+    for tensor in tf.nest.flatten(element):
+        if tensor.dtype == tf.string:
+            total += int(tf.reduce_sum(tf.strings.length(tensor)))
+        else:
+            total += int(tf.size(tensor)) * tensor.dtype.size
+    return total
+
+
+def shuffle_buffer_bytes(examples, buffer_size, num_samples=100):
+    # estimated memory of a full shuffle buffer over `examples`, from the mean size of a sample
+    sizes = [_element_bytes(element) for element in examples.take(num_samples)]
+    return buffer_size * sum(sizes) / max(len(sizes), 1)
+
+
+def time_to_first_batch(dataset):
+    # includes filling the shuffle buffer, which blocks the first training step
+    start = time.perf_counter()
+    next(iter(dataset))
+    return time.perf_counter() - start
+
+
+def make_train_batches(examples, format_image, batch_size, buffer_size, encoded=False, benchmark=False):
+    # Shuffled training batches. With `encoded`, the images of `examples` are still the JPEG/PNG bytes:
+    # the shuffle buffer keeps its length, so the order is as random, but holds a few KB per element
+    # instead of a decoded image, and decoding happens after the shuffle. With `benchmark` it prints the
+    # buffer memory and the time to the first batch, which fills the shuffle buffer once more.
+    dataset = examples.shuffle(buffer_size)
+    if encoded:
+        dataset = dataset.map(decode_example, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.map(format_image, num_parallel_calls=tf.data.AUTOTUNE).batch(batch_size).prefetch(1)
+    if benchmark:
+        print('Shuffle buffer: {:.1f} MB of {} images'.format(shuffle_buffer_bytes(examples, buffer_size) / 2 ** 20,
+                                                            'encoded' if encoded else 'decoded'))
+        print('Time to first batch: {:.2f}s'.format(time_to_first_batch(dataset)))
+    return dataset